@@ -0,0 +1,137 @@
+"""Benchmarks ssl_test.py end to end against the mock SSL Labs API in mock_ssllabs.py
+
+For each list size a fresh ssl_test.py process scans that many made up domains
+against the mock API, and the harness reports hosts per minute, requests per
+host, the p50/p99 time from a host's first request to its full results being
+served, and the peak RSS of the ssl_test.py process.
+
+Arguments:
+
+Optional:
+
+--sizes             : Comma seperated list of domain counts to run (default 100,1000,10000)
+--concurrency       : Passed to ssl_test.py --concurrency (default 50)
+--min_poll_interval : Passed to ssl_test.py --min_poll_interval (default 1)
+--max_poll_interval : Passed to ssl_test.py --max_poll_interval (default 10)
+--extra_args        : Any other arguments to pass to ssl_test.py, e.g. "--full_polls"
+--results_file      : Path to write the results to as JSON
+
+The mock API options from mock_ssllabs.py (--duration, --rate_429, --payload_kb, ...)
+are also accepted. The assessment duration defaults to 5 seconds here.
+
+Example Usage
+
+python3 benchmark.py --sizes 100,1000 --duration 10 --max_assessments 50
+python3 benchmark.py --sizes 1000 --rate_429 0.02 --extra_args "--full_polls"
+
+"""
+# Built in
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock_ssllabs
+
+SSL_TEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ssl_test.py")
+
+def percentile(values: list[float], pct: float) -> float:
+  """Nearest-rank percentile, 0 if there are no values"""
+  if not values:
+    return 0.0
+  values = sorted(values)
+  rank = max(int(round(pct / 100 * len(values))) - 1, 0)
+  return values[min(rank, len(values) - 1)]
+
+def run_benchmark(size: int, state: mock_ssllabs.MockState, api_url: str, args: argparse.Namespace) -> dict:
+  """Runs ssl_test.py against size domains and returns the measurements"""
+  state.reset_stats()
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    sites_path = os.path.join(tmp_dir, "sites.txt")
+    with open(sites_path, "w", encoding="utf-8") as f:
+      for i in range(size):
+        f.write(f"bench-{i}.example\n")
+
+    cmd = [
+      sys.executable, SSL_TEST_PATH,
+      "--sites_file", sites_path,
+      "--api_url", api_url,
+      "--concurrency", str(args.concurrency),
+      "--min_poll_interval", str(args.min_poll_interval),
+      "--max_poll_interval", str(args.max_poll_interval),
+      "--output", os.devnull,
+    ] + shlex.split(args.extra_args)
+
+    log_path = os.path.join(tmp_dir, "ssl_test.log")
+    with open(log_path, "w", encoding="utf-8") as log:
+      started = time.monotonic()
+      proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+      # wait4 gives the resource usage of just this child, including its peak RSS
+      _, status, usage = os.wait4(proc.pid, 0)
+      elapsed = time.monotonic() - started
+
+    exit_code = os.waitstatus_to_exitcode(status)
+    if exit_code != 0:
+      with open(log_path, encoding="utf-8") as log:
+        print(log.read()[-2000:])
+      raise SystemError(f"ssl_test.py exited with {exit_code} for {size} domains")
+
+  # ru_maxrss is in KB on Linux and bytes on macOS
+  peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+  time_to_result = state.time_to_result()
+
+  return {
+    "domains": size,
+    "completed": len(time_to_result),
+    "elapsed": elapsed,
+    "hosts_per_minute": size / elapsed * 60,
+    "requests": state.requests,
+    "requests_per_host": state.requests / size,
+    "bytes_sent": state.bytes_sent,
+    "status_counts": dict(state.status_counts),
+    "p50_time_to_result": percentile(time_to_result, 50),
+    "p99_time_to_result": percentile(time_to_result, 99),
+    "peak_rss_mb": peak_rss_mb,
+  }
+
+def print_benchmark(results: list[dict]) -> None:
+  """Outputs the results as a table"""
+  print(f"{'Domains':>8} {'Done':>8} {'Elapsed':>9} {'Hosts/min':>10} {'Req/host':>9} {'p50 TTR':>8} {'p99 TTR':>8} {'Peak RSS':>9} {'429s':>6}")
+  for r in results:
+    print(
+      f"{r['domains']:>8} {r['completed']:>8} {r['elapsed']:>8.1f}s {r['hosts_per_minute']:>10.1f} {r['requests_per_host']:>9.2f} "
+      f"{r['p50_time_to_result']:>7.1f}s {r['p99_time_to_result']:>7.1f}s {r['peak_rss_mb']:>7.1f}MB {r['status_counts'].get(429, 0):>6}"
+    )
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--sizes", default="100,1000,10000", help="Comma seperated list of domain counts to run")
+  parser.add_argument("--concurrency", type=int, default=50, help="Passed to ssl_test.py --concurrency")
+  parser.add_argument("--min_poll_interval", type=float, default=1, help="Passed to ssl_test.py --min_poll_interval")
+  parser.add_argument("--max_poll_interval", type=float, default=10, help="Passed to ssl_test.py --max_poll_interval")
+  parser.add_argument("--extra_args", default="", help="Any other arguments to pass to ssl_test.py")
+  parser.add_argument("--results_file", help="Path to write the results to as JSON")
+  mock_ssllabs.add_config_arguments(parser)
+  parser.set_defaults(duration=5)
+  args = parser.parse_args()
+
+  server, state = mock_ssllabs.start_server(mock_ssllabs.config_from_args(args))
+  api_url = f"http://127.0.0.1:{server.server_address[1]}/api/v2"
+
+  results = []
+  for size in [int(s) for s in args.sizes.split(",")]:
+    print(f"Running benchmark with {size} domains....")
+    results.append(run_benchmark(size, state, api_url, args))
+
+  server.shutdown()
+  print_benchmark(results)
+
+  if args.results_file:
+    with open(args.results_file, "w", encoding="utf-8") as f:
+      json.dump(results, f, indent=2)
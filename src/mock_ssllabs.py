@@ -0,0 +1,366 @@
+"""A local stand-in for the SSL Labs v2 API, used for testing and benchmarking ssl_test.py
+
+Serves /analyze, /getEndpointData and /info with assessments that move through
+DNS -> IN_PROGRESS -> READY (or ERROR) over a configurable duration, and can
+inject 429/503/529 responses and pad the full results to a given size.
+
+Arguments:
+
+Optional:
+
+--port          : The port to listen on (default 8080)
+--duration      : How long in seconds each assessment takes (default 30)
+--jitter        : Fraction of the duration that is randomly added or removed per host (default 0.2)
+--endpoints     : The number of endpoints (IP addresses) each host has (default 2)
+--error_rate    : Fraction of hosts whose assessment ends in ERROR (default 0)
+--rate_429      : Fraction of requests answered with a 429 (default 0)
+--rate_503      : Fraction of requests answered with a 503 (default 0)
+--rate_529      : Fraction of requests answered with a 529 (default 0)
+--retry_after   : Send a Retry-After header with this many seconds on injected errors
+--payload_kb    : Approximate size in KB of the details for each endpoint (default 4)
+--max_assessments : The number of concurrent assessments allowed (default 25)
+--cool_off      : Milliseconds required between starting new assessments (default 0)
+
+Example Usage
+
+python3 mock_ssllabs.py --port 8080 --duration 10 --rate_429 0.01
+python3 ssl_test.py --api_url http://127.0.0.1:8080/api/v2 --sites "a.example,b.example"
+
+"""
+# Built in
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Fraction of the assessment spent resolving the host before any endpoints show up
+DNS_FRACTION = 0.1
+
+class MockConfig:
+  """Settings for how the mock API behaves"""
+
+  def __init__(
+    self,
+    duration: float = 30,
+    jitter: float = 0.2,
+    endpoints: int = 2,
+    error_rate: float = 0,
+    rate_429: float = 0,
+    rate_503: float = 0,
+    rate_529: float = 0,
+    retry_after: int | None = None,
+    payload_kb: float = 4,
+    max_assessments: int = 25,
+    cool_off: int = 0
+  ) -> None:
+    self.duration = duration
+    self.jitter = jitter
+    self.endpoints = endpoints
+    self.error_rate = error_rate
+    self.rate_429 = rate_429
+    self.rate_503 = rate_503
+    self.rate_529 = rate_529
+    self.retry_after = retry_after
+    self.payload_kb = payload_kb
+    self.max_assessments = max_assessments
+    self.cool_off = cool_off
+
+class Assessment:
+  """The state of one host's assessment"""
+
+  def __init__(self, host: str, config: MockConfig, index: int) -> None:
+    self.host = host
+    self.started = time.monotonic()
+    self.duration = config.duration * random.uniform(1 - config.jitter, 1 + config.jitter)
+    self.will_error = random.random() < config.error_rate
+    # Hand out addresses from the documentation ranges so they never clash with real hosts
+    self.ips = [f"192.0.2.{(index * config.endpoints + i) % 254 + 1}" for i in range(config.endpoints)]
+
+  def elapsed(self) -> float:
+    return time.monotonic() - self.started
+
+  def status(self) -> str:
+    elapsed = self.elapsed()
+    if elapsed >= self.duration:
+      return "ERROR" if self.will_error else "READY"
+    if elapsed < self.duration * DNS_FRACTION:
+      return "DNS"
+    return "IN_PROGRESS"
+
+class MockState:
+  """Assessments and request statistics shared by all request handlers"""
+
+  def __init__(self, config: MockConfig) -> None:
+    self.config = config
+    self.lock = threading.Lock()
+    self.assessments = {}
+    self.last_start = 0.0
+    self.reset_stats()
+
+  def reset_stats(self) -> None:
+    """Clears the statistics and all assessments, e.g. between benchmark runs"""
+    with self.lock:
+      self.assessments = {}
+      # Hosts whose assessments may still be running, so counting them doesn't mean walking every host
+      self.active = set()
+      self.requests = 0
+      self.bytes_sent = 0
+      self.status_counts = {}
+      self.host_requests = {}
+      # When each host was first seen and when its full results were first served
+      self.first_seen = {}
+      self.result_served = {}
+
+  def current_assessments(self) -> int:
+    self.active = {h for h in self.active if self.assessments[h].status() in ("DNS", "IN_PROGRESS")}
+    return len(self.active)
+
+  def time_to_result(self) -> list[float]:
+    """Seconds from the first request for a host until its full results were served"""
+    with self.lock:
+      return [self.result_served[h] - self.first_seen[h] for h in self.result_served]
+
+class MockHandler(BaseHTTPRequestHandler):
+  """Handles requests for the mock API"""
+
+  protocol_version = "HTTP/1.1"
+  # Headers and body are written separately, which otherwise adds a delayed ACK wait to every keep-alive request
+  disable_nagle_algorithm = True
+  state = None
+
+  def log_message(self, format: str, *args) -> None:
+    # Keep the benchmark output readable
+    pass
+
+  def do_GET(self) -> None:
+    url = urlparse(self.path)
+    params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+    # Work out the response while holding the lock, but write it out after
+    # releasing it so slow clients don't hold up everyone else
+    with self.state.lock:
+      self.state.requests += 1
+      host = params.get("host")
+      if host:
+        self.state.host_requests[host] = self.state.host_requests.get(host, 0) + 1
+        self.state.first_seen.setdefault(host, time.monotonic())
+
+      status, body = self.route(url.path, params)
+      current = self.state.current_assessments()
+
+    self.send_json(status, body, current)
+
+  def route(self, path: str, params: dict) -> tuple[int, dict]:
+    config = self.state.config
+    host = params.get("host")
+
+    injected = self.pick_injected_error()
+    if injected:
+      return injected, {"errors": [{"message": "Injected error"}]}
+
+    if path.endswith("/info"):
+      return 200, {
+        "engineVersion": "mock",
+        "criteriaVersion": "mock",
+        "maxAssessments": config.max_assessments,
+        "currentAssessments": self.state.current_assessments(),
+        "newAssessmentCoolOff": config.cool_off,
+        "messages": [],
+      }
+    if path.endswith("/analyze") and host:
+      return self.handle_analyze(host, params)
+    if path.endswith("/getEndpointData") and host and "s" in params:
+      return self.handle_endpoint_data(host, params["s"])
+    return 400, {"errors": [{"message": "Malformed request"}]}
+
+  def pick_injected_error(self) -> int | None:
+    config = self.state.config
+    roll = random.random()
+    for status, rate in ((429, config.rate_429), (503, config.rate_503), (529, config.rate_529)):
+      if roll < rate:
+        return status
+      roll -= rate
+    return None
+
+  def handle_analyze(self, host: str, params: dict) -> tuple[int, dict]:
+    config = self.state.config
+    assessment = self.state.assessments.get(host)
+
+    from_cache = params.get("fromCache") == "on"
+    if from_cache and assessment is not None and "maxAge" in params:
+      if assessment.elapsed() > float(params["maxAge"]) * 3600:
+        assessment = None
+
+    in_progress = assessment is not None and assessment.status() in ("DNS", "IN_PROGRESS")
+    wants_new = assessment is None or (params.get("startNew") == "on" and not in_progress)
+    if wants_new:
+      now = time.monotonic()
+      if self.state.current_assessments() >= config.max_assessments:
+        return 429, {"errors": [{"message": "Running at full capacity. Please try again later."}]}
+      if now - self.state.last_start < config.cool_off / 1000:
+        return 429, {"errors": [{"message": "Cool-off period after each new assessment"}]}
+      self.state.last_start = now
+      assessment = Assessment(host, config, len(self.state.assessments))
+      self.state.assessments[host] = assessment
+      self.state.active.add(host)
+
+    return 200, self.build_analyze(assessment, params.get("all") == "done")
+
+  def handle_endpoint_data(self, host: str, ip: str) -> tuple[int, dict]:
+    assessment = self.state.assessments.get(host)
+    if assessment is None or ip not in assessment.ips:
+      return 400, {"errors": [{"message": "Unknown endpoint"}]}
+
+    endpoint = self.build_endpoint(assessment, assessment.ips.index(ip), True)
+    if assessment.status() == "READY":
+      self.state.result_served.setdefault(assessment.host, time.monotonic())
+    return 200, endpoint
+
+  def build_analyze(self, assessment: Assessment, full: bool) -> dict:
+    status = assessment.status()
+    response = {
+      "host": assessment.host,
+      "port": 443,
+      "protocol": "http",
+      "isPublic": False,
+      "status": status,
+      "startTime": int(time.time() * 1000 - assessment.elapsed() * 1000),
+      "engineVersion": "mock",
+      "criteriaVersion": "mock",
+    }
+
+    if status == "ERROR":
+      response["statusMessage"] = "Unable to resolve domain name"
+      return response
+    if status == "DNS":
+      response["statusMessage"] = "Resolving domain names"
+      return response
+
+    response["endpoints"] = [self.build_endpoint(assessment, i, full) for i in range(len(assessment.ips))]
+    if status == "READY" and full:
+      self.state.result_served.setdefault(assessment.host, time.monotonic())
+    return response
+
+  def build_endpoint(self, assessment: Assessment, index: int, full: bool) -> dict:
+    config = self.state.config
+    # Endpoints are assessed one after the other, like the real API
+    scan_time = assessment.duration * (1 - DNS_FRACTION)
+    per_endpoint = scan_time / len(assessment.ips)
+    endpoint_start = assessment.duration * DNS_FRACTION + per_endpoint * index
+    elapsed = assessment.elapsed()
+
+    endpoint = {"ipAddress": assessment.ips[index], "serverName": assessment.host, "delegation": 1}
+    if assessment.status() == "READY" or elapsed >= endpoint_start + per_endpoint:
+      endpoint.update(statusMessage="Ready", grade="A", gradeTrustIgnored="A", hasWarnings=False, isExceptional=False, progress=100, eta=0, duration=int(per_endpoint * 1000))
+    elif elapsed >= endpoint_start:
+      done = (elapsed - endpoint_start) / per_endpoint
+      endpoint.update(statusMessage="In progress", statusDetails="TESTING_PROTOCOLS", progress=int(done * 100), eta=max(int(per_endpoint - (elapsed - endpoint_start)), 1))
+    else:
+      endpoint.update(statusMessage="Pending", progress=-1, eta=-1)
+
+    if full and endpoint["statusMessage"] == "Ready":
+      endpoint["details"] = self.build_details(assessment, config.payload_kb)
+    return endpoint
+
+  def build_details(self, assessment: Assessment, payload_kb: float) -> dict:
+    now_ms = int(time.time() * 1000)
+    details = {
+      "hostStartTime": now_ms,
+      "cert": {
+        "subject": f"CN={assessment.host},O=Mock Org,C=US",
+        "commonNames": [assessment.host],
+        "altNames": [assessment.host, f"*.{assessment.host}"],
+        "notBefore": now_ms - 30 * 86400 * 1000,
+        "notAfter": now_ms + 60 * 86400 * 1000,
+        "issuerSubject": "CN=Mock CA,O=Mock Org,C=US",
+        "issuerLabel": "Mock CA",
+        "sigAlg": "SHA256withRSA",
+        "sha1Hash": hashlib.sha1(assessment.host.encode("utf-8")).hexdigest(),
+      },
+      "protocols": [{"id": 771, "name": "TLS", "version": "1.2"}, {"id": 772, "name": "TLS", "version": "1.3"}],
+      "suites": {"list": []},
+    }
+
+    # Pad with cipher suites until the details are roughly the requested size
+    suite = {"id": 49199, "name": "TLS_ECDHE_RSA_WITH_AES_128_GCM_SHA256", "cipherStrength": 128, "ecdhBits": 256, "ecdhStrength": 3072}
+    suite_size = len(json.dumps(suite))
+    for _ in range(int(payload_kb * 1024 / suite_size)):
+      details["suites"]["list"].append(suite)
+    return details
+
+  def send_json(self, status: int, body: dict, current_assessments: int) -> None:
+    config = self.state.config
+    payload = json.dumps(body).encode("utf-8")
+
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(payload)))
+    self.send_header("X-Max-Assessments", str(config.max_assessments))
+    self.send_header("X-Current-Assessments", str(current_assessments))
+    if status != 200 and config.retry_after is not None:
+      self.send_header("Retry-After", str(config.retry_after))
+    self.end_headers()
+    self.wfile.write(payload)
+
+    with self.state.lock:
+      self.state.bytes_sent += len(payload)
+      self.state.status_counts[status] = self.state.status_counts.get(status, 0) + 1
+
+def start_server(config: MockConfig, port: int = 0) -> tuple[ThreadingHTTPServer, MockState]:
+  """Starts the mock API on a background thread. Port 0 picks a free port."""
+  state = MockState(config)
+  handler = type("BoundMockHandler", (MockHandler,), {"state": state})
+  server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server, state
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+  """Adds the arguments for MockConfig, shared with the benchmark"""
+  parser.add_argument("--duration", type=float, default=30, help="How long in seconds each assessment takes")
+  parser.add_argument("--jitter", type=float, default=0.2, help="Fraction of the duration randomly added or removed per host")
+  parser.add_argument("--endpoints", type=int, default=2, help="The number of endpoints each host has")
+  parser.add_argument("--error_rate", type=float, default=0, help="Fraction of hosts whose assessment ends in ERROR")
+  parser.add_argument("--rate_429", type=float, default=0, help="Fraction of requests answered with a 429")
+  parser.add_argument("--rate_503", type=float, default=0, help="Fraction of requests answered with a 503")
+  parser.add_argument("--rate_529", type=float, default=0, help="Fraction of requests answered with a 529")
+  parser.add_argument("--retry_after", type=int, help="Send a Retry-After header with this many seconds on injected errors")
+  parser.add_argument("--payload_kb", type=float, default=4, help="Approximate size in KB of the details for each endpoint")
+  parser.add_argument("--max_assessments", type=int, default=25, help="The number of concurrent assessments allowed")
+  parser.add_argument("--cool_off", type=int, default=0, help="Milliseconds required between starting new assessments")
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+  return MockConfig(
+    duration=args.duration,
+    jitter=args.jitter,
+    endpoints=args.endpoints,
+    error_rate=args.error_rate,
+    rate_429=args.rate_429,
+    rate_503=args.rate_503,
+    rate_529=args.rate_529,
+    retry_after=args.retry_after,
+    payload_kb=args.payload_kb,
+    max_assessments=args.max_assessments,
+    cool_off=args.cool_off
+  )
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--port", type=int, default=8080, help="The port to listen on")
+  add_config_arguments(parser)
+  args = parser.parse_args()
+
+  server, state = start_server(config_from_args(args), args.port)
+  print(f"Mock SSL Labs API listening on http://127.0.0.1:{server.server_address[1]}/api/v2")
+  try:
+    while True:
+      time.sleep(60)
+      print(f"{state.requests} requests, {len(state.assessments)} assessments, {state.status_counts}")
+  except KeyboardInterrupt:
+    server.shutdown()
@@ -2,31 +2,135 @@
 
 Arguments:
 
-Required:
+Required (one of):
 
---sites : A comma seperated list of sites to run the scan against
+--sites      : A comma seperated list of sites to run the scan against
+--sites_file : A file with one site per line or a CSV with the site in the first column.
+               Can be gzip compressed. Use - to read from stdin.
+
+Either can be left out with --queue to only work on sites already in the queue.
 
 Optional:
 
 --force_test  : Force new tests to be run instead of using existing test results
 --use_cache   : Explicitly use cached test results from within the cached time frame
--d, --debug   : Enable debugging output
--v, --verbose : Enable verbose output
+--concurrency : The number of sites to assess at the same time (default 10)
+--full_polls  : Request the full results on every poll instead of only the status
+--endpoint_data : Fetch the full results per endpoint from /getEndpointData once the test is ready
+--cache_db    : Path to a SQLite file used to cache parsed results locally between runs
+--cache_ttl   : How long in hours a locally cached result is used before the site is assessed again (default 24)
+--cache_raw   : Also store the raw API response in the local cache
+--journal     : Path to a file that records the progress of each site as the run goes
+--resume      : Resume an interrupted run from the journal, skipping finished sites
+--output      : Path to a file to write the results to instead of stdout
+--output_order : Write results in "input" order (default) or in "completion" order
+--reorder_buffer : How many sites can finish ahead of the oldest unfinished one in input order (default 50)
+--endpoint_fields : A comma seperated list of endpoint fields to output instead of the default report.
+                    Nested fields are separated by dots and lists can be indexed or wildcarded,
+                    e.g. "ipAddress,grade,details.protocols[*].name"
+--backend     : "ssllabs" (default) to assess sites with the SSL Labs API, or "tls" to only pull the
+                certificate from every address of the site with a direct TLS handshake
+--tls_port    : The port to connect to with the tls backend (default 443)
+--api_url     : Base URL of the SSL Labs API, e.g. to point at mock_ssllabs.py (default https://api.ssllabs.com/api/v2)
+--rate_limit  : The most API requests to send per second across every worker sharing --rate_limit_db
+--rate_limit_burst : How many requests can be sent back to back before the rate limit applies (default 1 second's worth)
+--rate_limit_db : Path to a SQLite file holding the rate limit state, shared by every process that uses it
+--request_deadline : The longest time in seconds to keep retrying a single API request (default 1800)
+--pipeline    : Start assessments for as many sites as the API allows, then check on all of them in turn
+                from a single loop without threads. --concurrency is not used in this mode.
+--workers     : Split the sites across this many worker processes (default 1). The same site always
+                goes to the same worker, and any --rate_limit is shared between them.
+--queue       : Claim sites from a work queue shared with other runs instead of scanning the whole list.
+                Any sites given are added to the queue first, and each result is written back to it.
+                A plain path or sqlite:///path uses a SQLite file.
+--lease_time  : How long in seconds a claimed site stays with this run without being renewed before
+                another run can take it over (default 600)
+--json_decoder : The library used to decode API responses: "msgspec", "orjson" or "json". Defaults to the
+                 fastest one installed. Only the parts of each response the script reads are kept.
+--expiry_alerts : Path to write an alert for every certificate close to expiring to, as JSON lines, or - for
+                  stdout. Certificates from earlier runs in --cache_db are checked too.
+--expiry_thresholds : Comma seperated days before expiry to alert at (default 30,14,7,1)
+--incremental : Only reassess sites whose addresses or certificates changed since the result in --cache_db.
+                Each site gets a quick TLS handshake with every address, and if the addresses and
+                certificates match the stored result it's used as is.
+--max_age     : With --incremental, how long in hours a stored result can be reused for before the site
+                is reassessed anyway (default 168)
+--timing_file : Path to write how long each site spent in each phase to, and every request made for it,
+                as JSON lines written as each site finishes. A summary of the timings is logged at the end of the run.
+--min_poll_interval : The shortest time in seconds to wait between polls of a site (default 5)
+--max_poll_interval : The longest time in seconds to wait between polls of a site (default 120)
+-d, --debug   : Enable debugging output, including the API responses
+-v, --verbose : Enable verbose output (the default)
+-q, --quiet   : Only output warnings and errors
+
+Status messages are written to stderr as JSON lines, so stdout only has the results.
 
 Example Usage
 
 python3 ssl_test.py --sites "www.chase.com,www.espn.com,www.google.com"
 python3 ssl_test.py --sites "www.google.com" --force_test -v -d
+python3 ssl_test.py --sites "www.chase.com,www.espn.com,www.google.com" --concurrency 3
+python3 ssl_test.py --sites_file domains.txt --queue /shared/queue.db --output node1.txt
+gunzip -c domains.txt.gz | python3 ssl_test.py --sites_file -
 
 """
 # Built in
+import abc
 import argparse
+import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import csv
 import datetime
+import email.utils
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import random
+import re
+import socket
+import sqlite3
+import ssl
+import sys
+import tempfile
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
 
 # 3rd party
 import requests
 
-from time import sleep
+# Optional faster JSON decoders, the json module is used when neither is installed
+try:
+  import msgspec
+except ImportError:
+  msgspec = None
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# Optional, certificate dates are worked out for a batch of results at once with it
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from time import monotonic, sleep
 
 # How old of the cache results we want to use in hours
 CACHE_AGE = "1"
@@ -34,6 +138,9 @@ CACHE_AGE = "1"
 # Base API URL
 SSL_LABS_BASE_URL = "https://api.ssllabs.com/api/v2"
 
+# Header names to skip if they show up in the first row of a sites file
+SITES_FILE_HEADERS = {"host", "hostname", "domain", "site", "sites"}
+
 # The number of times to retry a request before giving up
 MAX_RETRIES = 3
 
@@ -43,10 +150,10 @@ force_new_test = False
 # Turns off using cached results
 use_cache = False
 
-# Show debugging output
-debug = False
-# Show verbose output
-verbose = True
+# Status messages go through this as JSON lines on stderr, set up by setup_logging()
+logger = logging.getLogger("ssl_test")
+# Background thread that writes the queued log records
+log_listener = None
 
 # Default fields to get values from each endpoint object
 endpoint_fields = [
@@ -62,250 +169,3067 @@ endpoint_fields = [
 # Use dyanmic endpoint fields
 use_end_point_fields = False
 
+# Only ask for the assessment status while polling and fetch the full results once it is READY
+poll_status_only = True
+# Fetch the full results one endpoint at a time from /getEndpointData
+use_endpoint_data = False
+
 # The amount of time in seconds to wait between requests
 sleep_time = 15
+# sleep_time goes back down to this once the API stops rate limiting us
+BASE_SLEEP_TIME = 15
+# and never grows past this
+MAX_SLEEP_TIME = 300
+
+# The longest time in seconds to keep retrying a single request
+request_deadline = 1800
+
+# Consecutive failed requests before all requests are paused until the API recovers
+CIRCUIT_FAILURE_THRESHOLD = 5
+# How long in seconds to pause before letting a single probe request through,
+# doubling each time the probe fails up to the max
+CIRCUIT_RESET_TIMEOUT = 30
+CIRCUIT_MAX_RESET_TIMEOUT = 900
+# How long in seconds to wait on a probe request before another worker is let through as the probe instead,
+# longer than the connect and read timeouts of a single request
+CIRCUIT_PROBE_TIMEOUT = 120
+
+# Bounds in seconds for the time between polls of a single site
+min_poll_interval = 5
+max_poll_interval = 120
+# Fraction of the poll interval that is randomly added or removed so sites don't poll in lockstep
+POLL_JITTER = 0.1
+
+# The number of status polls made for each site
+poll_counts = {}
+
+# The number of sites to assess at the same time
+max_concurrency = 10
+
+# "ssllabs" to assess sites with the SSL Labs API, "tls" to handshake with each address directly
+scan_backend = "ssllabs"
+# The port the tls backend connects to
+tls_probe_port = 443
+
+# Start every assessment the API allows up front and harvest them from one loop
+pipeline_mode = False
+
+# The number of worker processes to split the sites across, and the command line
+# arguments they are configured from, set up by enable_workers()
+worker_count = 1
+worker_args = None
+# Points per worker on the consistent hash ring, more points spread sites more evenly
+HASH_RING_REPLICAS = 64
+# How many sites can be queued up for each worker at once
+WORKER_QUEUE_SIZE = 1000
+# How often in seconds to check the workers are still alive while waiting on their results
+WORKER_CHECK_INTERVAL = 1
+# Connection counts reported back by worker processes
+worker_connection_stats = {"requests": 0, "new_connections": 0, "reused_connections": 0}
+
+# Library used to decode API responses, set up by set_json_decoder()
+json_decoder = "msgspec" if msgspec is not None else "orjson" if orjson is not None else "json"
+# Compiled response projections, keyed by the kind of response and the fields in use
+response_projections = {}
+
+# Index of certificate expiry dates and where to write alerts from it, set up by enable_expiry_alerts()
+expiry_index = None
+expiry_alerts_path = None
+# Days before a certificate expires to alert at
+expiry_thresholds = [30, 14, 7, 1]
+
+# Most results formatted and written at once, and the longest a result waits to be written
+WRITE_BATCH_SIZE = 1000
+WRITE_FLUSH_INTERVAL = 1.0
+
+# Shared queue sites are claimed from instead of the input list, set up by enable_work_queue()
+work_queue = None
+# How long a claimed site is held before another run can take it over
+lease_time = 600
+# How long to wait before checking again when every remaining site is leased by another run
+QUEUE_IDLE_WAIT = 5
+# Handed to the pipelined runner instead of a site when nothing can be claimed yet, so it can carry on polling
+NO_SITE_YET = object()
+
+# Limits the rate of API requests, set up by enable_rate_limit()
+rate_limiter = None
+
+# Local cache of parsed results, set up by enable_result_cache()
+result_cache = None
+# How long in hours a locally cached result is used for
+local_cache_ttl = 24
+# The number of sites answered from the local cache
+local_cache_hits = 0
+# Where the time went for each site still being worked on, keyed by site
+site_timings = {}
+# The timing of the site being worked on, carried into the threads that do its requests
+current_site_timing = contextvars.ContextVar("current_site_timing", default=None)
+# How many API requests got each HTTP status, or "connection" if they didn't get one
+request_status_counts = {}
+# Where to write the timing of each site, set up by enable_timing_file()
+timing_path = None
+# The open timing file while a run is going
+timing_stream = None
+# Handed each site's timing once the site is finished, set to send them back to the parent in worker processes
+timing_sink = None
+# How many sites' timings are sampled for the percentiles in the timing summary
+TIMING_SAMPLE_SIZE = 10000
+# How many of the slowest sites the timing summary lists
+TIMING_SLOWEST_SITES = 5
+
+# Only reassess sites that changed since their cached result, set up by enable_incremental()
+incremental_mode = False
+# How long in hours a cached result is reused for in incremental mode, as long as the site is unchanged
+incremental_max_age = 168
+# The number of sites found unchanged in incremental mode
+unchanged_sites = 0
+
+# Where results are written to, None for stdout
+output_path = None
+# Write results in "input" order or in "completion" order
+output_order = "input"
+# How many sites can finish ahead of the oldest unfinished one when writing in input order
+reorder_buffer_size = 50
+
+# Journal of each site's progress, set up by enable_journal()
+checkpoint_journal = None
+# The last journal entry for each site when resuming a run
+resume_states = {}
+# The number of finished sites that were taken from the journal
+resumed_sites = 0
+
+# Timeouts in seconds for connecting to and reading from the API
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+# How often in seconds to refresh the assessment limits from /info while waiting for a free slot
+CAPACITY_REFRESH_INTERVAL = 30
 
 def enable_force_test() -> None:
-  """Turns on debugging output"""
+  """Always starts a new test instead of using cached results"""
   global force_new_test
 
   force_new_test = True
 
 def enable_cache_use() -> None:
-  """Enables verbose output"""
+  """Allows cached results from the API to be used"""
   global use_cache
 
   use_cache = True
 
-def enable_debugging() -> None:
-  """Turns on debugging output"""
-  global debug
+class JSONLogFormatter(logging.Formatter):
+  """Formats a log record as a line of JSON, with any fields passed in with extra= next to the message"""
+
+  # Attributes every record has, anything else came from extra=
+  STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+  def format(self, record: logging.LogRecord) -> str:
+    entry = {
+      "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+      "level": record.levelname,
+      "message": record.getMessage(),
+    }
+    for key, value in vars(record).items():
+      if key not in self.STANDARD_ATTRIBUTES:
+        entry[key] = value
+    if record.exc_info:
+      entry["exception"] = self.formatException(record.exc_info)
+    return json.dumps(entry, default=str)
+
+class SiteContextFilter(logging.Filter):
+  """Tags each record with the site being worked on when it was logged"""
+
+  def filter(self, record: logging.LogRecord) -> bool:
+    if not hasattr(record, "site"):
+      timing = current_site_timing.get()
+      if timing is not None:
+        record.site = timing.host
+    return True
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+  """Queues records as they are, so the message and any extra fields are only formatted on the listener thread.
 
-  debug = True
+  The stdlib handler formats the record up front so it can be pickled, which
+  isn't needed for a queue inside this process. Anything passed to a logging
+  call must not be changed afterwards.
+  """
 
-def enable_verbose() -> None:
-  """Enables verbose output"""
-  global verbose
+  def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+    return record
 
-  verbose = True
+def setup_logging(level: int = logging.INFO) -> None:
+  """Sends status messages to a background thread that writes them to stderr, so logging never holds up the scan"""
+  global log_listener
+
+  stop_logging()
+
+  log_queue = queue.SimpleQueue()
+  handler = LazyQueueHandler(log_queue)
+  handler.addFilter(SiteContextFilter())
+  stream_handler = logging.StreamHandler(sys.stderr)
+  stream_handler.setFormatter(JSONLogFormatter())
+
+  # Replaces the handlers a worker process inherits from its parent
+  logger.handlers = [handler]
+  logger.setLevel(level)
+  logger.propagate = False
+
+  log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+  log_listener.start()
+  atexit.register(stop_logging)
+
+def stop_logging() -> None:
+  """Writes out any queued messages and stops the background thread"""
+  global log_listener
+
+  if log_listener is not None:
+    log_listener.stop()
+    log_listener = None
+
+def enable_full_polls() -> None:
+  """Requests the full results on every poll"""
+  global poll_status_only
+
+  poll_status_only = False
+
+def enable_endpoint_data() -> None:
+  """Fetches full results per endpoint from /getEndpointData"""
+  global use_endpoint_data
+
+  use_endpoint_data = True
 
 def increase_sleep_time() -> None:
   """Updates the amount of time we wait between requests to avoid rate limiting"""
   global sleep_time
 
-  sleep_time += 5
+  sleep_time = min(sleep_time + 5, MAX_SLEEP_TIME)
+
+def decrease_sleep_time() -> None:
+  """Eases the time we wait between requests back down after a successful request"""
+  global sleep_time
+
+  if sleep_time > BASE_SLEEP_TIME:
+    sleep_time = max(sleep_time * 0.9, BASE_SLEEP_TIME)
+
+def set_request_deadline(seconds: float) -> None:
+  """Sets the longest time to keep retrying a single request"""
+  global request_deadline
+
+  request_deadline = seconds
+
+def set_concurrency(limit: int) -> None:
+  """Sets the number of sites that are assessed at the same time"""
+  global max_concurrency
+
+  if limit < 1:
+    raise ValueError(f"Concurrency must be at least 1, got {limit}")
+  max_concurrency = limit
+
+def set_api_url(url: str) -> None:
+  """Points API calls at a different base URL"""
+  global SSL_LABS_BASE_URL
+
+  SSL_LABS_BASE_URL = url.rstrip("/")
+
+def set_backend(backend: str, port: int = tls_probe_port) -> None:
+  """Sets which backend sites are scanned with"""
+  global scan_backend, tls_probe_port
+
+  if backend not in ("ssllabs", "tls"):
+    raise ValueError(f"Unknown backend {backend}")
+  scan_backend = backend
+  tls_probe_port = port
+
+def enable_pipeline() -> None:
+  """Turns on the start everything, then harvest mode"""
+  global pipeline_mode
+
+  pipeline_mode = True
+
+def enable_workers(count: int, args: argparse.Namespace) -> None:
+  """Splits the sites across count worker processes, each set up from the given command line arguments"""
+  global worker_count, worker_args
+
+  if count < 1:
+    raise ValueError(f"Need at least 1 worker, got {count}")
+  worker_count = count
+  worker_args = args
+
+def set_json_decoder(name: str) -> None:
+  """Picks the library used to decode API responses"""
+  global json_decoder
+
+  if name not in ("msgspec", "orjson", "json"):
+    raise ValueError(f"Unknown JSON decoder {name}")
+  if (name == "msgspec" and msgspec is None) or (name == "orjson" and orjson is None):
+    raise ValueError(f"The {name} JSON decoder is not installed")
+  json_decoder = name
+  response_projections.clear()
+
+def enable_expiry_alerts(path: str, thresholds: list[int] | None = None) -> None:
+  """Indexes the expiry date of every certificate seen and writes alerts for the ones within the thresholds to path"""
+  global expiry_index, expiry_alerts_path, expiry_thresholds
+
+  if thresholds is not None:
+    if not thresholds or min(thresholds) <= 0:
+      raise ValueError(f"Expiry thresholds must be above 0 days, got {thresholds}")
+    expiry_thresholds = sorted(thresholds, reverse=True)
+  expiry_index = ExpiryIndex()
+  expiry_alerts_path = path
+
+def enable_timing_file(path: str) -> None:
+  """Writes the timing of every site to path as each one finishes"""
+  global timing_path
+
+  timing_path = path
+
+def enable_incremental(max_age: float = incremental_max_age) -> None:
+  """Only reassesses sites whose addresses or certificates changed since their cached result, or that were last assessed over max_age hours ago"""
+  global incremental_mode, incremental_max_age
 
-def get_nested_dict_value(nested_keys: list[str], dict: dict) -> object:
-  """Takes a list of keys and a dictionary and returns the value"""
-  if len(nested_keys) == 1:
-    return dict[nested_keys[0]]
+  if result_cache is None:
+    raise ValueError("--incremental requires --cache_db")
+  if max_age <= 0:
+    raise ValueError(f"Max age must be above 0 hours, got {max_age}")
+  incremental_mode = True
+  incremental_max_age = max_age
+
+def enable_work_queue(url: str, lease: float = lease_time) -> None:
+  """Claims sites from the work queue at url instead of scanning the input list"""
+  global work_queue, lease_time
+
+  if lease <= 0:
+    raise ValueError(f"Lease time must be above 0, got {lease}")
+  work_queue = open_work_queue(url)
+  lease_time = lease
+
+def enable_rate_limit(rate: float, burst: float | None = None, path: str | None = None) -> None:
+  """Limits API requests to rate per second. With path the limit is shared with every other process using the same file."""
+  global rate_limiter
+
+  if rate <= 0:
+    raise ValueError(f"Rate limit must be above 0, got {rate}")
+  rate_limiter = RateLimiter(rate, burst, path)
+
+def enable_result_cache(path: str, ttl: float = local_cache_ttl, store_raw: bool = False) -> None:
+  """Turns on the local result cache stored in the SQLite file at path"""
+  global result_cache, local_cache_ttl
+
+  local_cache_ttl = ttl
+  result_cache = ResultCache(path, ttl, store_raw)
+
+def enable_journal(path: str, resume: bool = False) -> None:
+  """Records the progress of each site to the journal at path. With resume, picks up where the journal left off."""
+  global checkpoint_journal, resume_states
+
+  if resume and os.path.exists(path):
+    resume_states = CheckpointJournal.load(path)
+  checkpoint_journal = CheckpointJournal(path)
+
+def set_output(path: str | None, order: str = "input", buffer_size: int = reorder_buffer_size) -> None:
+  """Sets where results are written to and in what order"""
+  global output_path, output_order, reorder_buffer_size
+
+  if order not in ("input", "completion"):
+    raise ValueError(f"Unknown output order {order}")
+  if buffer_size < 1:
+    raise ValueError(f"Reorder buffer must hold at least 1 site, got {buffer_size}")
+  output_path = path
+  output_order = order
+  reorder_buffer_size = buffer_size
+
+def set_poll_interval(min_interval: float, max_interval: float) -> None:
+  """Sets the bounds for the time between polls of a single site"""
+  global min_poll_interval, max_poll_interval
+
+  if min_interval <= 0 or max_interval < min_interval:
+    raise ValueError(f"Invalid poll interval bounds {min_interval} to {max_interval}")
+  min_poll_interval = min_interval
+  max_poll_interval = max_interval
+
+def next_poll_delay(response: dict, elapsed: float) -> float:
+  """Works out how long to wait before polling a site again.
+
+  Uses the ETA reported for the endpoints that are still being assessed. If
+  there is no ETA yet, the remaining time is estimated from the reported
+  progress and how long the site has been running. Falls back to sleep_time
+  when neither is available.
+  """
+  etas = []
+  progress = []
+  for endpoint in response.get("endpoints", []):
+    if endpoint.get("statusMessage") == "Ready":
+      continue
+    if endpoint.get("eta", -1) > 0:
+      etas.append(endpoint["eta"])
+    if 0 < endpoint.get("progress", -1) < 100:
+      progress.append(endpoint["progress"])
+
+  if etas:
+    # Endpoints are assessed one at a time, so check back when the current one should be done
+    delay = max(etas)
+  elif progress:
+    delay = elapsed * (100 - min(progress)) / min(progress)
+  elif not response.get("endpoints"):
+    # Still resolving the host, which is quick
+    delay = min_poll_interval
   else:
-    return get_nested_dict_value(nested_keys[1:], dict[nested_keys[0]])
+    delay = sleep_time
+
+  delay *= random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+  return min(max(delay, min_poll_interval), max_poll_interval)
+
+def record_poll(site: str) -> None:
+  """Counts a status poll for the site"""
+  poll_counts[site] = poll_counts.get(site, 0) + 1
+
+def normalize_site(site: str) -> str | None:
+  """Cleans up a site name so the same host is always written the same way. Returns None for blank or commented out entries."""
+  site = site.strip().lower()
+  if not site or site.startswith("#"):
+    return None
+
+  # Allow full URLs to be pasted in
+  if "://" in site:
+    site = site.split("://", 1)[1]
+  site = site.split("/", 1)[0]
+  if site.count(":") == 1:
+    site = site.split(":", 1)[0]
+
+  return site.rstrip(".") or None
+
+def unique_sites(sites: Iterable[str]) -> Iterator[str]:
+  """Normalizes sites and drops any that have already been seen, without reading ahead"""
+  seen = set()
+  for site in sites:
+    site = normalize_site(site)
+    if site is None or site in seen:
+      continue
+    seen.add(site)
+    yield site
+
+def read_sites_file(path: str) -> Iterator[str]:
+  """Lazily reads sites from a file, or stdin if path is -.
+
+  Takes either one site per line or a CSV with the site in the first column.
+  Gzip compressed input is detected and decompressed on the fly.
+  """
+  source = sys.stdin.buffer if path == "-" else open(path, "rb")
+  try:
+    raw = source
+    # GzipFile doesn't close the file it wraps, so source is kept to be closed below
+    if isinstance(source, io.BufferedReader) and source.peek(2)[:2] == b"\x1f\x8b":
+      raw = gzip.GzipFile(fileobj=source)
+
+    text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    for row_num, row in enumerate(csv.reader(text)):
+      if not row:
+        continue
+      if row_num == 0 and row[0].strip().lower() in SITES_FILE_HEADERS:
+        continue
+      yield row[0]
+  finally:
+    if path != "-":
+      source.close()
+
+def set_endpoint_fields(fields: list[str]) -> None:
+  """Switches the output to the given endpoint fields. The paths are compiled here so a bad one fails before the run starts."""
+  global endpoint_fields, compiled_endpoint_fields, use_end_point_fields
+
+  compiled_endpoint_fields = [FieldPath(f) for f in fields]
+  endpoint_fields = fields
+  use_end_point_fields = True
+
+class FieldPath:
+  """An endpoint field path compiled once into the keys needed to look it up.
+
+  Paths are dot separated keys with optional list indexes, e.g.
+  "details.cert.subject", "details.certChains[0].id" or
+  "details.protocols[*].name". A [*] wildcard returns a list with the rest of
+  the path looked up in every element. Missing keys and indexes give the
+  default instead of raising.
+  """
+
+  __slots__ = ("path", "steps", "has_wildcard")
 
-def get_request(request_str: str) -> dict:
-  """Wrapper function to initate get request and handle non-200 return codes"""
+  # Step used for a [*] wildcard
+  WILDCARD = object()
+  PART_PATTERN = re.compile(r"([^\[\]]*)((?:\[(?:-?\d+|\*)\])*)")
+  INDEX_PATTERN = re.compile(r"\[(-?\d+|\*)\]")
 
-  retry_num = 0
-  while retry_num < MAX_RETRIES:
+  def __init__(self, path: str) -> None:
+    steps = []
+    for part in path.split("."):
+      match = self.PART_PATTERN.fullmatch(part)
+      if match is None or (not match.group(1) and not match.group(2)):
+        raise ValueError(f"Invalid endpoint field path '{path}'")
+      if match.group(1):
+        steps.append(match.group(1))
+      for index in self.INDEX_PATTERN.findall(match.group(2)):
+        steps.append(self.WILDCARD if index == "*" else int(index))
+
+    self.path = path
+    self.steps = tuple(steps)
+    self.has_wildcard = self.WILDCARD in self.steps
+
+  def get(self, obj: object, default: object = None) -> object:
+    """Looks the path up in obj"""
+    if self.has_wildcard:
+      return self.walk(obj, 0, default)
+
+    for step in self.steps:
+      try:
+        obj = obj[step]
+      except (KeyError, IndexError, TypeError):
+        return default
+    return obj
+
+  def walk(self, obj: object, start: int, default: object) -> object:
+    for i in range(start, len(self.steps)):
+      step = self.steps[i]
+      if step is self.WILDCARD:
+        if not isinstance(obj, list):
+          return default
+        return [self.walk(item, i + 1, default) for item in obj]
+      try:
+        obj = obj[step]
+      except (KeyError, IndexError, TypeError):
+        return default
+    return obj
+
+# The endpoint_fields paths compiled for parse_response()
+compiled_endpoint_fields = [FieldPath(f) for f in endpoint_fields]
+
+# Fields read from every endpoint, whatever the output
+ENDPOINT_STATUS_FIELDS = ["ipAddress", "statusMessage", "eta", "progress"]
+# Fields read from every endpoint for the default report
+REPORT_ENDPOINT_FIELDS = [
+  "grade", "hasWarnings", "details.cert.subject", "details.cert.altNames", "details.cert.notBefore", "details.cert.notAfter"
+]
+# Fields read from an /analyze response outside of its endpoints
+ANALYZE_FIELDS = ["host", "status", "statusMessage"]
+
+class ResponseProjection:
+  """Decodes API responses keeping only the fields the script reads.
+
+  The field paths are merged into a tree of the keys to keep, where None
+  means keep the whole value and ITEMS stands for every element of a list.
+  With msgspec the tree becomes a set of Struct types, so the rest of the
+  response is skipped over while decoding rather than built and thrown away.
+  Other decoders build the full response and then drop what isn't needed, so
+  less is held on to. Missing keys stay missing either way.
+  """
+
+  __slots__ = ("tree", "decoder")
+
+  # Key in the tree for the elements of a list
+  ITEMS = object()
+
+  def __init__(self, paths: Iterable[FieldPath]) -> None:
+    self.tree = {}
+    for path in paths:
+      node = self.tree
+      for i, step in enumerate(path.steps):
+        key = step if isinstance(step, str) else self.ITEMS
+        if i == len(path.steps) - 1:
+          node[key] = None
+          break
+        child = node.get(key, {})
+        # Already keeping the whole value
+        if child is None:
+          break
+        node[key] = child
+        node = child
+
+    self.decoder = None
+    if json_decoder == "msgspec":
+      self.decoder = msgspec.json.Decoder(self.struct_type(self.tree, "Response"))
+
+  @classmethod
+  def struct_type(cls, tree: dict | None, name: str) -> object:
+    """Builds the msgspec type that decodes just the keys in tree"""
+    if tree is None:
+      return object
+    if cls.ITEMS in tree:
+      # A value can't be read as both an object and a list, so keep it all
+      if len(tree) > 1:
+        return object
+      return list[cls.struct_type(tree[cls.ITEMS], f"{name}Item")] | None
+
+    # Keys are renamed from placeholders since they don't have to be valid identifiers
+    fields = [
+      (f"f{i}", cls.struct_type(child, f"{name}{i}") | msgspec.UnsetType, msgspec.UNSET)
+      for i, child in enumerate(tree.values())
+    ]
+    rename = {f"f{i}": key for i, key in enumerate(tree)}
+    return msgspec.defstruct(name, fields, rename=rename) | None
+
+  def project(self, obj: object, tree: dict | None) -> object:
+    """Drops everything from an already decoded obj that isn't in tree"""
+    if tree is None:
+      return obj
+    if isinstance(obj, list) and self.ITEMS in tree:
+      return [self.project(item, tree[self.ITEMS]) for item in obj]
+    if isinstance(obj, dict):
+      return {key: self.project(obj[key], child) for key, child in tree.items() if key in obj}
+    return obj
+
+  def decode(self, content: bytes) -> object:
+    """Decodes a response body keeping only the projected fields"""
+    if self.decoder is not None:
+      try:
+        # UNSET fields are left out, so missing keys stay missing
+        return msgspec.to_builtins(self.decoder.decode(content))
+      except msgspec.ValidationError:
+        # Something isn't the shape the projection expects, keep it all rather than guess
+        return self.project(msgspec.json.decode(content), self.tree)
+    return self.project(decode_json(content), self.tree)
+
+def decode_json(content: bytes) -> object:
+  """Decodes a whole JSON body with the fastest decoder available"""
+  if json_decoder == "msgspec":
+    return msgspec.json.decode(content)
+  if json_decoder == "orjson":
+    return orjson.loads(content)
+  return json.loads(content)
+
+def get_projection(kind: str) -> ResponseProjection | None:
+  """Returns the projection for an "analyze" or "endpoint" response, or None if the whole response is needed"""
+  # The raw responses in the cache are meant to be complete
+  if result_cache is not None and result_cache.store_raw:
+    return None
+
+  key = (kind, current_fields_key())
+  if key not in response_projections:
+    paths = ENDPOINT_STATUS_FIELDS + (endpoint_fields if use_end_point_fields else REPORT_ENDPOINT_FIELDS)
+    if kind == "analyze":
+      paths = ANALYZE_FIELDS + [f"endpoints[*].{path}" for path in paths]
+    response_projections[key] = ResponseProjection(FieldPath(path) for path in paths)
+  return response_projections[key]
+
+class AssessmentCapacity:
+  """Tracks how many assessments the API will let us run at once.
+
+  The limits come from the /info endpoint and from the X-Max-Assessments and
+  X-Current-Assessments headers that are returned with every API response.
+  A slot has to be acquired before an assessment is started and released once
+  it has finished.
+  """
+
+  def __init__(self, max_assessments: int = 1) -> None:
+    self.lock = threading.Lock()
+    self.max_assessments = max_assessments
+    # Number of assessments the API says are running for this client
+    self.current_assessments = 0
+    # Number of slots held by this process
+    self.in_flight = 0
+    # Minimum time in seconds between starting new assessments
+    self.cool_off = 0.0
+    self.next_start = 0.0
+    # When the limits were last checked with /info
+    self.last_refresh = None
+    # The /info request in flight, shared by every task waiting on it
+    self.refresh_task = None
+
+  def update_from_info(self, info: dict) -> None:
+    """Updates the limits from an /info response"""
+    with self.lock:
+      self.max_assessments = info.get("maxAssessments", self.max_assessments)
+      self.current_assessments = info.get("currentAssessments", self.current_assessments)
+      self.cool_off = info.get("newAssessmentCoolOff", 0) / 1000
+
+  def update_from_headers(self, headers: dict) -> None:
+    """Updates the limits from the headers of any API response"""
+    with self.lock:
+      if "X-Max-Assessments" in headers:
+        self.max_assessments = int(headers["X-Max-Assessments"])
+      if "X-Current-Assessments" in headers:
+        self.current_assessments = int(headers["X-Current-Assessments"])
+
+  def mark_full(self) -> None:
+    """Stops new assessments from starting until the API reports a free slot again"""
+    with self.lock:
+      self.current_assessments = max(self.current_assessments, self.max_assessments)
+
+  def try_acquire(self) -> bool:
+    """Takes a slot if one is free. Returns False if the caller needs to wait."""
+    with self.lock:
+      now = monotonic()
+      if now < self.next_start:
+        return False
+      if max(self.in_flight, self.current_assessments) >= self.max_assessments:
+        return False
+      self.in_flight += 1
+      self.current_assessments += 1
+      self.next_start = now + self.cool_off
+      return True
+
+  def release(self) -> None:
+    """Gives back a slot once an assessment has finished"""
+    with self.lock:
+      self.in_flight = max(self.in_flight - 1, 0)
+      self.current_assessments = max(self.current_assessments - 1, 0)
+
+  async def acquire(self) -> None:
+    """Waits until a slot is free and takes it"""
+    # The first assessment waits for /info, so the real limit and cool-off are known before anything is started
+    if self.last_refresh is None:
+      await self.refresh()
+
+    while not self.try_acquire():
+      # Our own view of the running assessments can go stale if nothing else is
+      # talking to the API, so check in with /info every so often
+      if monotonic() - self.last_refresh >= CAPACITY_REFRESH_INTERVAL:
+        await self.refresh()
+      await asyncio.sleep(1)
+
+  async def refresh(self) -> None:
+    """Checks the limits with /info, sharing one request between every task that asks at the same time"""
+    if self.refresh_task is None:
+      self.refresh_task = asyncio.ensure_future(self.fetch_info())
+    task = self.refresh_task
     try:
-      result = requests.get(SSL_LABS_BASE_URL + request_str)
-    except requests.exceptions.ConnectionError as e:
-      print(f"Unable to connect to remote server with error {e}.")
-      print(f"Sleeping {sleep_time} seconds and trying again")
-    if result.status_code == 200:
-      return result.json()
-    
-    elif result.status_code == 400:
-      print("Malform API call")
-      print(result.status_code)
-      raise SystemError(f"Error with malformed API call with request string {request_str}")
-
-    elif result.status_code == 429:
-      print("We are being rate limited....")
-      increase_sleep_time()
-      print(f"Increasing sleep time to {sleep_time}....")
-      sleep(sleep_time)
-
-    elif result.status_code == 500:
-      print("Internal service error....")
-      print("Sleeping and running again....")
-      sleep(sleep_time)
-
-    elif result.status_code in [503, 529]:
-      print("Service overloaded....")
-      print("Pausing for 15 minutes....")
-      sleep(900)
-    
-    retry_num += 1
-  raise SystemError("Exceeded max retries. Erroring out....")
-  
-def check_test_exists(site: str, use_cache: bool = False) -> tuple[bool, dict]:
-  """Checks to see if the test results are available yet"""
-  request_str = f"/analyze?host={site}&all=done"
-  
-  if use_cache:
-    request_str += f"&fromCache=on&maxAge={CACHE_AGE}"
+      await task
+    finally:
+      if self.refresh_task is task:
+        self.refresh_task = None
 
-  response = get_request(request_str)
+  async def fetch_info(self) -> None:
+    try:
+      await asyncio.to_thread(get_info)
+    except Exception as e:
+      logger.warning(
+        "Unable to get assessment limits from /info, keeping limit of %d", self.max_assessments, extra={"error": str(e)}
+      )
+    finally:
+      self.last_refresh = monotonic()
 
-  if response["status"] == "READY":
-    exists = True
+# Shared view of the assessment limits for this run
+assessment_capacity = AssessmentCapacity()
+
+# Shared HTTP session for this process, created on first use by get_session()
+session = None
+session_pid = None
+session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+  """Returns the HTTP session shared by every request in this process.
+
+  The session keeps connections to the API alive in a pool sized to the
+  concurrency limit, so polls reuse an open connection instead of doing a new
+  TCP and TLS handshake each time.
+  """
+  global session, session_pid
+
+  with session_lock:
+    # Connections can't be shared with a parent process after a fork
+    if session is None or session_pid != os.getpid():
+      session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+      session.mount("https://", adapter)
+      session.mount("http://", adapter)
+      session.headers.update({"Accept-Encoding": "gzip, deflate"})
+      session_pid = os.getpid()
+
+  return session
+
+def get_connection_stats() -> dict:
+  """Returns how many requests were made and how many of them reused an open connection"""
+  stats = {"requests": 0, "new_connections": 0, "reused_connections": 0}
+  if session is not None and session_pid == os.getpid():
+    # The same adapter is mounted for both http:// and https://
+    for adapter in {id(a): a for a in session.adapters.values()}.values():
+      pools = adapter.poolmanager.pools
+      for key in pools.keys():
+        pool = pools[key]
+        stats["requests"] += pool.num_requests
+        stats["new_connections"] += pool.num_connections
+    stats["reused_connections"] = max(stats["requests"] - stats["new_connections"], 0)
+
+  # Plus whatever the worker processes reported
+  for key, value in worker_connection_stats.items():
+    stats[key] += value
+  return stats
+
+def collect_run_stats() -> dict:
+  """Gathers this process's statistics so a parent process can merge them into its run summary"""
+  return {
+    "connections": get_connection_stats(),
+    "poll_counts": poll_counts,
+    "local_cache_hits": local_cache_hits,
+    "resumed_sites": resumed_sites,
+    "unchanged_sites": unchanged_sites,
+    "request_status_counts": request_status_counts,
+    "circuit_breaker_trips": circuit_breaker.trips,
+  }
+
+def merge_run_stats(stats: dict) -> None:
+  """Adds the statistics from a worker process to this process's run summary"""
+  global local_cache_hits, resumed_sites, unchanged_sites
+
+  for key, value in stats["connections"].items():
+    worker_connection_stats[key] += value
+  poll_counts.update(stats["poll_counts"])
+  local_cache_hits += stats["local_cache_hits"]
+  resumed_sites += stats["resumed_sites"]
+  unchanged_sites += stats["unchanged_sites"]
+  for status, count in stats["request_status_counts"].items():
+    request_status_counts[status] = request_status_counts.get(status, 0) + count
+  circuit_breaker.trips += stats["circuit_breaker_trips"]
+
+def log_run_summary() -> None:
+  """Logs statistics about the run"""
+  conn_stats = get_connection_stats()
+  total_polls = sum(poll_counts.values())
+  if conn_stats["requests"]:
+    reuse_pct = 100 * conn_stats["reused_connections"] / conn_stats["requests"]
   else:
-    exists = False
-  
-  return exists, response
+    reuse_pct = 0.0
 
-def start_new_test(site: str) -> dict:
-  """Starts new test on the site that's passed in."""
-  request_str = f"/analyze?host={site}&startNew=on&all=done"
-  return get_request(request_str)
+  summary = {
+    "http_requests": conn_stats["requests"],
+    "new_connections": conn_stats["new_connections"],
+    "reused_connections": conn_stats["reused_connections"],
+    "reused_pct": round(reuse_pct, 1),
+    "status_polls": total_polls,
+  }
+  if result_cache is not None:
+    summary["local_cache_hits"] = local_cache_hits
+  if incremental_mode:
+    summary["unchanged_sites"] = unchanged_sites
+  if resume_states:
+    summary["resumed_sites"] = resumed_sites
+  if circuit_breaker.trips:
+    summary["circuit_breaker_trips"] = circuit_breaker.trips
+  if poll_counts:
+    busiest = max(poll_counts, key=poll_counts.get)
+    summary["polls_per_site_average"] = round(total_polls / len(poll_counts), 1)
+    summary["polls_per_site_max"] = poll_counts[busiest]
+    summary["busiest_site"] = busiest
+    if logger.isEnabledFor(logging.DEBUG):
+      summary["polls_per_site"] = poll_counts
 
-def get_test_results(site: str) -> dict:
-  """Gets test results. Will wait for test to finish if in progress."""
-  test_exists, response = check_test_exists(site, use_cache)
+  logger.info("Run summary", extra={"summary": summary})
+  log_timing_summary()
 
-  if not test_exists:
-    start_new_test(site)
+class SiteTiming:
+  """Where the time went for one site.
 
-  while not test_exists:
-    if verbose:
-      print("Test is not ready...")
-      print(f"Sleeping {sleep_time} seconds and trying again...")
-    sleep(sleep_time)
-    test_exists, response = check_test_exists(site)
-
-    if debug:
-      print(response)
-    
-    if response["status"] == "ERROR":
-      print(f"Test resulted in an error....")
-      print(f"Error Message: {response['statusMessage']}")
-      raise SystemError(response["statusMessage"])
-  
-  return response
+  Phases are in seconds. They can overlap, as the remote assessment covers the
+  requests and sleeps made while polling it. Every request is kept as a
+  (path, status, bytes, seconds) tuple.
+  """
 
-def parse_response(response: dict) -> dict:
-  """Takes full test result output and pulls relevant fields out. Can be used with either hardcoded fields or dynamic endpoint fields"""
+  __slots__ = ("host", "created", "elapsed", "phases", "requests")
 
-  results = {"host": response["host"], "endpoints": []}
-  
-  for endpoint in response["endpoints"]:
+  PHASES = ("queued", "http", "sleep", "assessment", "parse", "format")
+
+  def __init__(self, host: str) -> None:
+    self.host = host
+    self.created = monotonic()
+    self.elapsed = 0.0
+    self.phases = dict.fromkeys(self.PHASES, 0.0)
+    self.requests = []
+
+  def add(self, phase: str, seconds: float) -> None:
+    self.phases[phase] += seconds
+
+  def merge(self, data: dict) -> None:
+    """Adds in a timing from to_dict(), e.g. one sent back by a worker process"""
+    self.elapsed += data["elapsed"]
+    for phase in self.PHASES:
+      self.phases[phase] += data[phase]
+    self.requests.extend((r["path"], r["status"], r["bytes"], r["seconds"]) for r in data["requests"])
+
+  def to_dict(self) -> dict:
+    return {
+      "host": self.host,
+      "elapsed": round(self.elapsed, 4),
+      **{phase: round(seconds, 4) for phase, seconds in self.phases.items()},
+      "requests": [
+        {"path": path, "status": status, "bytes": size, "seconds": round(seconds, 4)}
+        for path, status, size, seconds in self.requests
+      ],
+    }
+
+class TimingSummary:
+  """Running totals of the finished sites' timings, kept in bounded memory however long the list is.
+
+  The percentiles come from a random sample of up to sample_size sites, and
+  only the slowest few sites are kept in full.
+  """
+
+  KEYS = ("elapsed",) + SiteTiming.PHASES
 
-    if use_end_point_fields:
-      ep = {}
-      for f in endpoint_fields:
-        nested_keys = f.split(".")
-        ep[f] = get_nested_dict_value(nested_keys, endpoint)
+  def __init__(self, sample_size: int = TIMING_SAMPLE_SIZE, slowest_count: int = TIMING_SLOWEST_SITES) -> None:
+    self.sample_size = sample_size
+    self.slowest_count = slowest_count
+    self.sites = 0
+    self.bytes = 0
+    self.totals = dict.fromkeys(self.KEYS, 0.0)
+    self.maxima = dict.fromkeys(self.KEYS, 0.0)
+    # Each sample is a site's values in KEYS order
+    self.samples = []
+    # Min-heap of (elapsed, sequence, host, phases), so the fastest of the slowest is dropped first
+    self.slowest = []
+    # Sites can finish on the writer's flush timer thread as well as the main one
+    self.lock = threading.Lock()
+
+  def add(self, timing: SiteTiming) -> None:
+    values = (timing.elapsed,) + tuple(timing.phases[phase] for phase in SiteTiming.PHASES)
+    self.sites += 1
+    self.bytes += sum(request[2] for request in timing.requests)
+    for key, value in zip(self.KEYS, values):
+      self.totals[key] += value
+      self.maxima[key] = max(self.maxima[key], value)
+
+    # Reservoir sampling, so every site has the same chance of being in the sample
+    if len(self.samples) < self.sample_size:
+      self.samples.append(values)
     else:
-      ep = {
-        "ip": endpoint["ipAddress"],
-        "grade": endpoint["grade"],
-        "warnings": endpoint["hasWarnings"],
-        "cert_subject": endpoint["details"]["cert"]["subject"],
-        "cert_alt_names": endpoint["details"]["cert"]["altNames"],
-        "cert_not_before": endpoint["details"]["cert"]["notBefore"],
-        "cert_not_after": endpoint["details"]["cert"]["notAfter"]
-        }
-    
-    results["endpoints"].append(ep)
-  
-  return results
+      i = random.randrange(self.sites)
+      if i < self.sample_size:
+        self.samples[i] = values
 
-def create_dynamic_endpoint_output(results: dict) -> list[str]:
-  """Generates formatted output for dynamic end point fields"""
+    entry = (timing.elapsed, self.sites, timing.host, dict(timing.phases))
+    if len(self.slowest) < self.slowest_count:
+      heapq.heappush(self.slowest, entry)
+    else:
+      heapq.heappushpop(self.slowest, entry)
 
-  output_arr = [
-    f"{results['host']}:",
-    "  Public Endpoints:"
-  ]
+# Totals for every site finished so far
+timing_summary = TimingSummary()
 
-  for endpoint in results["endpoints"]:
-    print(endpoint.keys())
-    for field in endpoint_fields:
-      output_arr.append(f"    {field}: {endpoint[field]}")
-  
-  return output_arr
+def get_site_timing(site: str) -> SiteTiming:
+  """Returns the timing for the site, starting it if this is the first time the site is seen"""
+  timing = site_timings.get(site)
+  if timing is None:
+    timing = site_timings[site] = SiteTiming(site)
+  return timing
 
+def finish_site_timing(site: str) -> None:
+  """Hands the timing of a finished site to the timing sink, or adds it to the summary and timing file"""
+  timing = site_timings.pop(site, None)
+  if timing is None:
+    return
+  if timing_sink is not None:
+    timing_sink(timing)
+    return
 
-def create_email_style_output(results: dict) -> list[str]:
-  """Creates formatted output and returns it as an array"""
-  output_arr = [
-    f"{results['host']}:",
-    "  Public Endpoints:"
+  with timing_summary.lock:
+    timing_summary.add(timing)
+    if timing_stream is not None:
+      timing_stream.write(json.dumps(timing.to_dict()) + "\n")
+
+@contextlib.contextmanager
+def timing_for(site: str) -> Iterator[SiteTiming]:
+  """Records the phases inside the block against the site, including in threads started from it"""
+  timing = get_site_timing(site)
+  token = current_site_timing.set(timing)
+  try:
+    yield timing
+  finally:
+    current_site_timing.reset(token)
+    timing.elapsed = monotonic() - timing.created
+
+@contextlib.contextmanager
+def timed(phase: str) -> Iterator[None]:
+  """Adds the time spent in the block to a phase of the site being worked on, if there is one"""
+  started = monotonic()
+  try:
+    yield
+  finally:
+    timing = current_site_timing.get()
+    if timing is not None:
+      timing.add(phase, monotonic() - started)
+
+def record_request(request_str: str, status: int | str, size: int, seconds: float) -> None:
+  """Records an API request against the site being worked on"""
+  request_status_counts[status] = request_status_counts.get(status, 0) + 1
+  timing = current_site_timing.get()
+  if timing is not None:
+    timing.add("http", seconds)
+    timing.requests.append((request_str.split("?", 1)[0], status, size, seconds))
+
+def percentile(values: list[float], pct: float) -> float:
+  """Nearest-rank percentile of already sorted values, 0 if there are none"""
+  if not values:
+    return 0.0
+  rank = max(int(round(pct / 100 * len(values))) - 1, 0)
+  return values[min(rank, len(values) - 1)]
+
+def log_timing_summary() -> None:
+  """Logs where the time went across every finished site"""
+  summary = timing_summary
+  if not summary.sites:
+    return
+
+  phases = {}
+  for i, key in enumerate(TimingSummary.KEYS):
+    values = sorted(sample[i] for sample in summary.samples)
+    phases[key] = {
+      "total": round(summary.totals[key], 3),
+      "p50": round(percentile(values, 50), 3),
+      "p90": round(percentile(values, 90), 3),
+      "p99": round(percentile(values, 99), 3),
+      "max": round(summary.maxima[key], 3),
+    }
+
+  slowest = [
+    {"host": host, "elapsed": round(elapsed, 3), **{phase: round(seconds, 3) for phase, seconds in site_phases.items()}}
+    for elapsed, _, host, site_phases in sorted(summary.slowest, reverse=True)
   ]
-  for endpoint in results["endpoints"]:
-    output_arr.append(f"    IP Address: {endpoint['ip']}")
-    output_arr.append(f"    Grade     : {endpoint['grade']}")
-    output_arr.append(f"    Warnings  : {str(endpoint['warnings'])}")
-    output_arr.append(f"    SSL Cert  :")
-    output_arr.append(f"        Subject Name    : {endpoint['cert_subject'].split('=')[1]}")
-    output_arr.append(f"        Alternative Name: {' '.join(endpoint['cert_alt_names'])}")
-    output_arr.append(f"        Not Valid Before: {datetime.datetime.fromtimestamp(endpoint['cert_not_before']/1000).strftime('%Y-%m-%d')}")
-    output_arr.append(f"        Not Valid After : {datetime.datetime.fromtimestamp(endpoint['cert_not_after']/1000).strftime('%Y-%m-%d')}")
-  
-  return output_arr
+  logger.info("Timing summary", extra={
+    "sites": summary.sites,
+    "phases": phases,
+    "requests": sum(request_status_counts.values()),
+    "bytes": summary.bytes,
+    "rate_limited": request_status_counts.get(429, 0),
+    "slowest_sites": slowest,
+  })
 
-def print_results(results: list[dict]) -> None:
-  """Outputs the results"""
+class ResultCache:
+  """SQLite backed cache of parsed results keyed by host.
 
-  for item in results:
-    if use_end_point_fields:
-      formatted_output = create_dynamic_endpoint_output(item)
-    else:
-      formatted_output = create_email_style_output(item)
-    print("\n".join(formatted_output))
+  Results are only handed back while they are younger than the TTL, and only
+  if they were parsed with the same endpoint fields that are in use now. Each
+  result can carry a fingerprint of the site's addresses and certificates,
+  which incremental mode uses to reuse older results for unchanged sites.
+  """
 
-def runner(sites: list[str]) -> None:
-  """Runs SSL assesment against list of sites passed in"""
+  def __init__(self, path: str, ttl_hours: float, store_raw: bool = False) -> None:
+    self.ttl = ttl_hours * 3600
+    self.store_raw = store_raw
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(path, check_same_thread=False)
+    with self.lock, self.conn:
+      self.conn.execute("PRAGMA journal_mode=WAL")
+      self.conn.execute(
+        "CREATE TABLE IF NOT EXISTS results ("
+        "host TEXT PRIMARY KEY, fields TEXT NOT NULL, parsed TEXT NOT NULL, raw TEXT, updated_at REAL NOT NULL, "
+        "fingerprint TEXT)"
+      )
+      # Caches made before fingerprints were stored
+      columns = [row[1] for row in self.conn.execute("PRAGMA table_info(results)")]
+      if "fingerprint" not in columns:
+        self.conn.execute("ALTER TABLE results ADD COLUMN fingerprint TEXT")
 
-  parsed_results = []
-  for site in sites:
+  def get(self, host: str) -> "HostResult | None":
+    """Returns the cached parsed results for host, or None if there isn't a fresh entry"""
+    with self.lock:
+      row = self.conn.execute(
+        "SELECT parsed FROM results WHERE host = ? AND fields = ? AND updated_at >= ?",
+        (host, current_fields_key(), time.time() - self.ttl)
+      ).fetchone()
+
+    if row is None:
+      return None
+    return HostResult.from_dict(json.loads(row[0]))
+
+  def all_results(self) -> Iterator["HostResult"]:
+    """Yields every cached result parsed with the fields in use, however old"""
+    with self.lock:
+      rows = self.conn.execute("SELECT parsed FROM results WHERE fields = ?", (current_fields_key(),)).fetchall()
+
+    for (parsed,) in rows:
+      yield HostResult.from_dict(json.loads(parsed))
+
+  def get_fingerprinted(self, host: str, max_age_hours: float) -> tuple["HostResult", str] | None:
+    """Returns the cached results for host and their fingerprint, if there are any younger than max_age_hours with a fingerprint"""
+    with self.lock:
+      row = self.conn.execute(
+        "SELECT parsed, fingerprint FROM results WHERE host = ? AND fields = ? AND updated_at >= ? AND fingerprint IS NOT NULL",
+        (host, current_fields_key(), time.time() - max_age_hours * 3600)
+      ).fetchone()
+
+    if row is None:
+      return None
+    return HostResult.from_dict(json.loads(row[0])), row[1]
+
+  def put(self, host: str, parsed: "HostResult", raw: dict | None = None, fingerprint: str | None = None) -> None:
+    """Stores the parsed results for host, replacing any older entry"""
+    raw_json = json.dumps(raw) if self.store_raw and raw is not None else None
+    with self.lock, self.conn:
+      self.conn.execute(
+        "INSERT OR REPLACE INTO results (host, fields, parsed, raw, updated_at, fingerprint) VALUES (?, ?, ?, ?, ?, ?)",
+        (host, current_fields_key(), json.dumps(parsed.to_dict()), raw_json, time.time(), fingerprint)
+      )
+
+  def close(self) -> None:
+    """Closes the underlying database connection"""
+    with self.lock:
+      self.conn.close()
+
+class CheckpointJournal:
+  """Append-only JSON lines journal of each site's progress.
+
+  Every change of state (started, polling, done or failed) is written and
+  synced to disk straight away, and finished sites carry their parsed
+  results, so an interrupted run can be resumed without losing any work.
+  """
+
+  def __init__(self, path: str) -> None:
+    self.lock = threading.Lock()
+
+    # Start on a fresh line if the last run died part way through writing an entry
+    needs_newline = False
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+      with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        needs_newline = f.read(1) != b"\n"
+
+    self.file = open(path, "a", encoding="utf-8")
+    if needs_newline:
+      self.file.write("\n")
+
+  def record(self, host: str, state: str, result: "HostResult | None" = None) -> None:
+    """Appends a state change for host to the journal"""
+    entry = {"host": host, "state": state, "time": time.time()}
+    if result is not None:
+      entry["result"] = result.to_dict()
+      # Results parsed with other endpoint fields or another backend can't be read back by this run
+      entry["fields"] = current_fields_key()
+
+    with self.lock:
+      self.file.write(json.dumps(entry) + "\n")
+      self.file.flush()
+      os.fsync(self.file.fileno())
+
+  def close(self) -> None:
+    """Closes the journal file"""
+    with self.lock:
+      self.file.close()
+
+  @staticmethod
+  def load(path: str) -> dict:
+    """Reads a journal and returns the last entry for each host"""
+    states = {}
+    with open(path, encoding="utf-8") as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except json.JSONDecodeError:
+          # The last line can be cut short if the run died while writing it
+          continue
+        states[entry["host"]] = entry
+
+    return states
+
+def connect_shared_db(path: str) -> sqlite3.Connection:
+  """Opens a SQLite file that several processes write to, for use with immediate_transaction()"""
+  # Autocommit mode so transactions can be started explicitly with BEGIN IMMEDIATE
+  return sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+
+@contextlib.contextmanager
+def immediate_transaction(conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+  """Runs the block as one write transaction.
+
+  BEGIN IMMEDIATE takes the write lock up front, so no other process can
+  change what the block reads before it writes back.
+  """
+  conn.execute("BEGIN IMMEDIATE")
+  try:
+    yield conn
+    conn.execute("COMMIT")
+  except BaseException:
+    conn.execute("ROLLBACK")
+    raise
+
+class RateLimiter:
+  """Token bucket that limits how many API requests are sent per second.
+
+  Without a path the bucket is kept in memory for this process. With a path
+  it lives in a SQLite file, so every process and container on the host that
+  points at the same file draws from one budget. A cool-down after a 429 or
+  overload response is stored the same way, so one worker backing off makes
+  all of them back off.
+  """
+
+  def __init__(self, rate: float, burst: float | None = None, path: str | None = None) -> None:
+    self.rate = rate
+    self.burst = burst if burst is not None else max(rate, 1)
+    self.lock = threading.Lock()
+    self.state = {"tokens": self.burst, "updated": time.time(), "cooldown_until": 0.0}
+    self.conn = None
+
+    if path is not None:
+      self.conn = connect_shared_db(path)
+      self.conn.execute(
+        "CREATE TABLE IF NOT EXISTS rate_limit ("
+        "id INTEGER PRIMARY KEY CHECK (id = 1), tokens REAL NOT NULL, updated REAL NOT NULL, cooldown_until REAL NOT NULL)"
+      )
+      self.conn.execute(
+        "INSERT OR IGNORE INTO rate_limit (id, tokens, updated, cooldown_until) VALUES (1, ?, ?, 0)",
+        (self.burst, time.time())
+      )
+
+  @contextlib.contextmanager
+  def bucket(self) -> Iterator[dict]:
+    """Gives exclusive access to the bucket state and saves any changes made to it"""
+    with self.lock:
+      if self.conn is None:
+        yield self.state
+        return
+
+      # Held from the read to the write so two processes can't both spend the same token
+      with immediate_transaction(self.conn) as conn:
+        tokens, updated, cooldown_until = conn.execute(
+          "SELECT tokens, updated, cooldown_until FROM rate_limit WHERE id = 1"
+        ).fetchone()
+        state = {"tokens": tokens, "updated": updated, "cooldown_until": cooldown_until}
+        yield state
+        conn.execute(
+          "UPDATE rate_limit SET tokens = ?, updated = ?, cooldown_until = ? WHERE id = 1",
+          (state["tokens"], state["updated"], state["cooldown_until"])
+        )
+
+  def try_take(self) -> float:
+    """Takes a token if one is available. Returns 0 if it did, otherwise how long to wait before trying again."""
+    # Wall clock time, since the state can be shared between processes
+    now = time.time()
+    with self.bucket() as state:
+      if now < state["cooldown_until"]:
+        return state["cooldown_until"] - now
+
+      state["tokens"] = min(self.burst, state["tokens"] + max(now - state["updated"], 0) * self.rate)
+      state["updated"] = now
+      if state["tokens"] >= 1:
+        state["tokens"] -= 1
+        return 0.0
+      return (1 - state["tokens"]) / self.rate
+
+  def acquire(self) -> None:
+    """Waits until a request can be sent"""
+    wait = self.try_take()
+    while wait > 0:
+      sleep(wait)
+      wait = self.try_take()
+
+  def cool_down(self, seconds: float) -> None:
+    """Stops every worker sharing the bucket from sending requests for the given time"""
+    with self.bucket() as state:
+      state["cooldown_until"] = max(state["cooldown_until"], time.time() + seconds)
+      state["tokens"] = 0.0
 
-    if force_new_test:
-      if verbose:
-        print("Force new test is enabled....")
-        print(f"Starting new test for {site} now....")
-      new_test = start_new_test(site)
-      if debug:
-        print(new_test)
+class RetryPolicy:
+  """Works out how long to wait before retrying a failed request.
+
+  Each kind of failure has a base delay and a cap. The wait for a retry is
+  picked at random between 0 and base * 2^attempt, capped ("full jitter"), so
+  workers that failed together don't all retry together. A Retry-After header
+  from the server is used as is instead. The back-off shared with other
+  workers leaves the jitter out, so it is never cut short.
+  """
+
+  # (base, cap) in seconds for each status. A base of None uses the current sleep_time,
+  # which grows while we are rate limited and shrinks again once requests go through.
+  DELAYS = {
+    "connection": (5, 120),
+    429: (None, MAX_SLEEP_TIME),
+    500: (5, 120),
+    503: (60, 900),
+    529: (60, 900),
+  }
+  DEFAULT_DELAY = (5, 120)
+
+  def backoff(self, status: int | str, attempt: int, retry_after: float | None = None) -> float:
+    """Returns how long to wait before retry number attempt (starting at 0) after a failure with status"""
+    if retry_after is not None:
+      return retry_after
+    return random.uniform(0, self.max_backoff(status, attempt))
+
+  def shared_backoff(self, status: int | str, attempt: int, retry_after: float | None = None) -> float:
+    """Returns how long every worker sharing the rate limit should back off for after a failure with status"""
+    if retry_after is not None:
+      return retry_after
+    return self.max_backoff(status, attempt)
+
+  def max_backoff(self, status: int | str, attempt: int) -> float:
+    base, cap = self.DELAYS.get(status, self.DEFAULT_DELAY)
+    if base is None:
+      base = sleep_time
+    return min(cap, base * 2 ** attempt)
+
+  @staticmethod
+  def parse_retry_after(value: str | None) -> float | None:
+    """Reads a Retry-After header, which can be a number of seconds or an HTTP date"""
+    if not value:
+      return None
     try:
-      response = get_test_results(site)
-    except Exception as e:
-      print(f"Error getting test results for {site}....")
-      print(f"Error was '{e}'")
-      continue
-    #print(response)
-    results = parse_response(response)
-    #print(results)
-    parsed_results.append(results)
-  
-  print_results(parsed_results)
-  
-  
+      return max(float(value), 0.0)
+    except ValueError:
+      pass
+    try:
+      retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+      return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
 
-if __name__ == "__main__":
-  
-  argparse = argparse.ArgumentParser()
-  argparse.add_argument("--sites", nargs="?", required=True, help="A comma seperated list of sites to query")
-  argparse.add_argument("--force_test", action="store_true")
-  argparse.add_argument("--use_cache", action="store_true")
-  argparse.add_argument("-d", "--debug", action="store_true")
-  argparse.add_argument("-v", "--verbose", action="store_true")
-  args = argparse.parse_args()
+# How failed requests are retried
+retry_policy = RetryPolicy()
 
-  if args.force_test:
-    print("Enabling force test")
-    enable_force_test()
-  
-  if args.use_cache:
-    enable_cache_use()
-  
-  if args.debug:
-    enable_debugging()
-  
-  if args.verbose:
-    enable_verbose()
+class CircuitBreaker:
+  """Pauses every request to the API while it looks to be down.
 
-  sites = args.sites.split(",")
-  
-  runner(sites)
\ No newline at end of file
+  After failure_threshold consecutive failures (connection errors and 5xx
+  responses) the circuit opens and every worker waits in wait(). Once the
+  reset timeout has passed a single request is let through as a probe. If it
+  works the circuit closes and all the waiting workers carry on at once. If
+  it fails the circuit opens again for twice as long. Callers can give up
+  once the API has been down for longer than they are willing to wait.
+  """
+
+  CLOSED = "closed"
+  OPEN = "open"
+  HALF_OPEN = "half-open"
+
+  def __init__(
+    self,
+    failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+    reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+    max_reset_timeout: float = CIRCUIT_MAX_RESET_TIMEOUT,
+    probe_timeout: float = CIRCUIT_PROBE_TIMEOUT
+  ) -> None:
+    self.failure_threshold = failure_threshold
+    self.reset_timeout = reset_timeout
+    self.max_reset_timeout = max_reset_timeout
+    self.probe_timeout = probe_timeout
+    self.condition = threading.Condition()
+    self.state = self.CLOSED
+    self.failures = 0
+    self.opened_at = 0.0
+    # When the circuit first opened in the current outage
+    self.outage_started = 0.0
+    self.current_timeout = reset_timeout
+    # The thread sending the probe request and when it was let through
+    self.probe_thread = None
+    self.probe_started = 0.0
+    # The number of times the circuit has opened
+    self.trips = 0
+
+  def is_open(self) -> bool:
+    with self.condition:
+      return self.state != self.CLOSED
+
+  def wait(self, max_outage: float | None = None) -> float:
+    """Blocks while the circuit is open and returns how many seconds were spent waiting.
+
+    When the reset timeout runs out the first caller is let through as the probe
+    and everyone else keeps waiting for its result. If the probe takes longer
+    than probe_timeout the next caller is let through as the probe instead.
+    Raises SystemError once the circuit has been open for over max_outage seconds.
+    """
+    started = monotonic()
+    with self.condition:
+      while self.state != self.CLOSED:
+        if self.state == self.OPEN:
+          deadline = self.opened_at + self.current_timeout
+        else:
+          deadline = self.probe_started + self.probe_timeout
+
+        if max_outage is not None and monotonic() >= self.outage_started + max_outage:
+          raise SystemError(f"Giving up, the API has been down for over {max_outage:.0f} seconds")
+
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+          self.state = self.HALF_OPEN
+          self.probe_thread = threading.get_ident()
+          self.probe_started = monotonic()
+          logger.warning("Sending a probe request to see if the API has recovered")
+          break
+        if max_outage is not None:
+          remaining = min(remaining, self.outage_started + max_outage - monotonic())
+        self.condition.wait(remaining)
+
+    return monotonic() - started
+
+  def record_success(self) -> None:
+    """Closes the circuit and wakes up every waiting worker"""
+    with self.condition:
+      self.failures = 0
+      if self.state != self.CLOSED:
+        logger.warning("API has recovered, resuming requests")
+        self.state = self.CLOSED
+        self.current_timeout = self.reset_timeout
+        self.condition.notify_all()
+
+  def record_failure(self) -> None:
+    """Counts a failure, opening the circuit once there have been too many in a row"""
+    with self.condition:
+      if self.state == self.HALF_OPEN:
+        self.current_timeout = min(self.current_timeout * 2, self.max_reset_timeout)
+        self.open()
+        return
+
+      self.failures += 1
+      if self.state == self.CLOSED and self.failures >= self.failure_threshold:
+        self.open()
+
+  def record_error(self) -> None:
+    """Counts an unexpected error as a failed probe if it came from the probe, so the waiting workers aren't left stuck"""
+    with self.condition:
+      if self.state == self.HALF_OPEN and self.probe_thread == threading.get_ident():
+        self.current_timeout = min(self.current_timeout * 2, self.max_reset_timeout)
+        self.open()
+
+  def open(self) -> None:
+    # Only called with the condition held
+    logger.warning("API looks to be down, pausing all requests for %.0f seconds", self.current_timeout)
+    if self.state == self.CLOSED:
+      self.outage_started = monotonic()
+    self.state = self.OPEN
+    self.opened_at = monotonic()
+    self.trips += 1
+    self.condition.notify_all()
+
+# Shared by every request so one outage pauses all workers together
+circuit_breaker = CircuitBreaker()
+
+class WorkQueue(abc.ABC):
+  """Queue of sites shared by every run working through the same list.
+
+  A run claims a site with a lease that it has to keep renewing while it
+  works on it. If the run dies the lease runs out and the site goes back to
+  the queue for another run to pick up. Finished results are written back to
+  the queue, so they can be collected no matter which run produced them.
+
+  Subclasses store the queue somewhere every run can reach. Register them in
+  WORK_QUEUE_BACKENDS under a URL scheme to make them usable with --queue.
+  """
+
+  @abc.abstractmethod
+  def add(self, sites: Iterable[str]) -> int:
+    """Adds sites that aren't already in the queue. Returns how many were added."""
+
+  @abc.abstractmethod
+  def claim(self, owner: str, lease: float) -> str | None:
+    """Leases the next available site to owner. Returns None if there isn't one right now."""
+
+  @abc.abstractmethod
+  def renew(self, owner: str, lease: float) -> int:
+    """Extends every lease held by owner. Returns how many were renewed."""
+
+  @abc.abstractmethod
+  def complete(self, site: str, owner: str, results: "HostResult") -> None:
+    """Stores the results for site and takes it out of the queue"""
+
+  @abc.abstractmethod
+  def fail(self, site: str, owner: str) -> None:
+    """Hands site back to the queue after a failed scan, or gives up on it after MAX_RETRIES attempts"""
+
+  @abc.abstractmethod
+  def remaining(self) -> int:
+    """Returns how many sites are waiting or leased"""
+
+  def close(self) -> None:
+    pass
+
+class SQLiteWorkQueue(WorkQueue):
+  """Work queue kept in a SQLite file.
+
+  Every run on the host, or on any host that can safely share the file, works
+  off the same table. Claims take the write lock with BEGIN IMMEDIATE so two
+  runs can never lease the same site.
+  """
+
+  def __init__(self, path: str) -> None:
+    self.lock = threading.Lock()
+    self.conn = connect_shared_db(path)
+    with self.lock:
+      self.conn.execute("PRAGMA journal_mode=WAL")
+      self.conn.execute(
+        "CREATE TABLE IF NOT EXISTS work_queue ("
+        "host TEXT PRIMARY KEY, status TEXT NOT NULL, owner TEXT, lease_expires REAL NOT NULL DEFAULT 0, "
+        "attempts INTEGER NOT NULL DEFAULT 0, result TEXT, updated_at REAL NOT NULL)"
+      )
+      self.conn.execute("CREATE INDEX IF NOT EXISTS work_queue_status ON work_queue (status, lease_expires)")
+
+  @contextlib.contextmanager
+  def transaction(self) -> Iterator[sqlite3.Connection]:
+    """Runs the block as one write transaction, one thread at a time since the connection is shared"""
+    with self.lock, immediate_transaction(self.conn) as conn:
+      yield conn
+
+  def add(self, sites: Iterable[str]) -> int:
+    added = 0
+    batch = []
+    for site in sites:
+      batch.append((site, time.time()))
+      # Batched so a long list doesn't hold the write lock for the whole insert
+      if len(batch) >= 1000:
+        added += self.insert(batch)
+        batch = []
+    if batch:
+      added += self.insert(batch)
+    return added
+
+  def insert(self, batch: list[tuple[str, float]]) -> int:
+    with self.transaction() as conn:
+      before = conn.total_changes
+      conn.executemany("INSERT OR IGNORE INTO work_queue (host, status, updated_at) VALUES (?, 'pending', ?)", batch)
+      return conn.total_changes - before
+
+  def claim(self, owner: str, lease: float) -> str | None:
+    # Lease expiry times are compared by runs on other hosts, so they can't be monotonic
+    now = time.time()
+    with self.transaction() as conn:
+      row = conn.execute(
+        "SELECT host FROM work_queue WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+        "ORDER BY status DESC, rowid LIMIT 1",
+        (now,)
+      ).fetchone()
+      if row is None:
+        return None
+      conn.execute(
+        "UPDATE work_queue SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? "
+        "WHERE host = ?",
+        (owner, now + lease, now, row[0])
+      )
+    return row[0]
+
+  def renew(self, owner: str, lease: float) -> int:
+    now = time.time()
+    with self.transaction() as conn:
+      return conn.execute(
+        "UPDATE work_queue SET lease_expires = ? WHERE status = 'leased' AND owner = ?",
+        (now + lease, owner)
+      ).rowcount
+
+  def complete(self, site: str, owner: str, results: "HostResult") -> None:
+    # Accepted even if the lease ran out, a finished result is worth keeping whoever holds the site now
+    with self.transaction() as conn:
+      conn.execute(
+        "UPDATE work_queue SET status = 'done', owner = ?, result = ?, updated_at = ? WHERE host = ? AND status != 'done'",
+        (owner, json.dumps(results.to_dict()), time.time(), site)
+      )
+
+  def fail(self, site: str, owner: str) -> None:
+    with self.transaction() as conn:
+      conn.execute(
+        "UPDATE work_queue SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+        "owner = NULL, lease_expires = 0, updated_at = ? WHERE host = ? AND status = 'leased' AND owner = ?",
+        (MAX_RETRIES, time.time(), site, owner)
+      )
+
+  def remaining(self) -> int:
+    with self.lock:
+      return self.conn.execute("SELECT COUNT(*) FROM work_queue WHERE status IN ('pending', 'leased')").fetchone()[0]
+
+  def close(self) -> None:
+    with self.lock:
+      self.conn.close()
+
+# Work queue classes by URL scheme, a plain path is treated as sqlite
+WORK_QUEUE_BACKENDS = {"sqlite": SQLiteWorkQueue}
+
+def open_work_queue(url: str) -> WorkQueue:
+  """Opens the work queue at url, e.g. "sqlite:///shared/queue.db" or just a file path"""
+  scheme, sep, location = url.partition("://")
+  if not sep:
+    return SQLiteWorkQueue(url)
+  if scheme not in WORK_QUEUE_BACKENDS:
+    raise ValueError(f"Unknown work queue type {scheme}, expected one of {', '.join(WORK_QUEUE_BACKENDS)}")
+  # sqlite:///abs/path keeps its leading slash, sqlite://rel/path doesn't have one
+  return WORK_QUEUE_BACKENDS[scheme](location)
+
+def current_fields_key() -> str:
+  """Identifies the shape of the parsed results so cached entries from another field set or backend aren't reused"""
+  key = ",".join(endpoint_fields) if use_end_point_fields else ""
+  if scan_backend != "ssllabs":
+    key = f"{scan_backend}|{key}"
+  return key
+
+def get_request(request_str: str, projection: ResponseProjection | None = None) -> dict:
+  """Wrapper function to initate get request and handle non-200 return codes.
+  With a projection only the fields it names are decoded from the response."""
+
+  deadline = monotonic() + request_deadline
+  attempt = 0
+  try:
+    while True:
+      # Time spent waiting out an outage doesn't count against this request's deadline,
+      # but the outage itself can't go on for longer than the deadline
+      with timed("sleep"):
+        deadline += circuit_breaker.wait(request_deadline)
+
+        if rate_limiter is not None:
+          rate_limiter.acquire()
+
+      retry_after = None
+      request_started = monotonic()
+      try:
+        result = get_session().get(SSL_LABS_BASE_URL + request_str, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+      except requests.exceptions.RequestException as e:
+        logger.warning("Unable to get a response from the remote server", extra={"error": str(e)})
+        status = "connection"
+        record_request(request_str, status, 0, monotonic() - request_started)
+      else:
+        assessment_capacity.update_from_headers(result.headers)
+        status = result.status_code
+        # The size on the wire, which is the compressed size when the response was gzipped
+        size = int(result.headers.get("Content-Length") or len(result.content))
+        record_request(request_str, status, size, monotonic() - request_started)
+
+        if status == 200:
+          circuit_breaker.record_success()
+          decrease_sleep_time()
+          with timed("parse"):
+            if projection is not None:
+              return projection.decode(result.content)
+            return decode_json(result.content)
+
+        elif status == 400:
+          circuit_breaker.record_success()
+          logger.error("Malformed API call", extra={"status": status, "request": request_str})
+          raise SystemError(f"Error with malformed API call with request string {request_str}")
+
+        elif status == 429:
+          logger.warning("We are being rate limited", extra={"status": status})
+          assessment_capacity.mark_full()
+          increase_sleep_time()
+
+        elif status == 500:
+          logger.warning("Internal service error", extra={"status": status})
+
+        elif status in [503, 529]:
+          logger.warning("Service overloaded", extra={"status": status})
+
+        else:
+          logger.warning("Unexpected status code %s", status, extra={"status": status})
+
+        retry_after = retry_policy.parse_retry_after(result.headers.get("Retry-After"))
+
+      if status == "connection" or status >= 500:
+        circuit_breaker.record_failure()
+        # The circuit breaker paces everyone while the API is down, so this
+        # doesn't use up a retry or sleep on its own
+        if circuit_breaker.is_open():
+          continue
+      else:
+        circuit_breaker.record_success()
+
+      attempt += 1
+      if attempt >= MAX_RETRIES:
+        break
+
+      delay = retry_policy.backoff(status, attempt - 1, retry_after)
+      if monotonic() + delay > deadline:
+        raise SystemError(f"Giving up on request string {request_str}, retrying would pass the {request_deadline} second deadline")
+
+      # Let every other worker sharing the rate limit know to back off too, for the full
+      # back-off rather than the jittered delay this worker happens to sleep for
+      if rate_limiter is not None and status in (429, 503, 529):
+        rate_limiter.cool_down(retry_policy.shared_backoff(status, attempt - 1, retry_after))
+
+      logger.info("Sleeping %.0f seconds and trying again", delay, extra={"request": request_str})
+      with timed("sleep"):
+        sleep(delay)
+  except Exception:
+    # Anything else going wrong in a probe still has to reopen the circuit
+    circuit_breaker.record_error()
+    raise
+
+  raise SystemError("Exceeded max retries. Erroring out....")
+
+def get_info() -> dict:
+  """Gets the assessment limits for this client from the /info endpoint"""
+  info = get_request("/info")
+  assessment_capacity.update_from_info(info)
+
+  logger.info(
+    "API allows %d concurrent assessments, %d currently running",
+    assessment_capacity.max_assessments, assessment_capacity.current_assessments
+  )
+
+  return info
+
+def check_test_exists(site: str, use_cache: bool = False, status_only: bool = False) -> tuple[bool, dict]:
+  """Checks to see if the test results are available yet. With status_only the endpoint details are left out of the response."""
+  request_str = f"/analyze?host={site}"
+
+  if not status_only:
+    request_str += "&all=done"
+
+  if use_cache:
+    request_str += f"&fromCache=on&maxAge={CACHE_AGE}"
+
+  response = get_request(request_str, get_projection("analyze"))
+
+  if response["status"] == "READY":
+    exists = True
+  else:
+    exists = False
+  
+  return exists, response
+
+def start_new_test(site: str) -> dict:
+  """Starts new test on the site that's passed in."""
+  request_str = f"/analyze?host={site}&startNew=on"
+
+  # A new test never has endpoint details yet, so only ask for them when polling for the full results
+  if not poll_status_only:
+    request_str += "&all=done"
+
+  return get_request(request_str, get_projection("analyze"))
+
+def get_full_results(site: str, response: dict, use_cache: bool = False) -> dict:
+  """Fetches the full results for a test that is READY. Only needed when polling for the status only."""
+  if use_endpoint_data:
+    endpoints = []
+    for endpoint in response["endpoints"]:
+      endpoints.append(get_request(f"/getEndpointData?host={site}&s={endpoint['ipAddress']}", get_projection("endpoint")))
+    return {**response, "endpoints": endpoints}
+
+  test_exists, full_response = check_test_exists(site, use_cache)
+  if not test_exists:
+    raise SystemError(f"Test results for {site} are no longer available")
+
+  return full_response
+
+async def async_get_test_results(site: str, resume: bool = False) -> dict:
+  """Gets test results, waiting for the test to finish if in progress. Waits between polls without blocking the other sites being assessed.
+
+  With resume, a test that is already in progress is polled instead of being started again.
+  """
+  started = monotonic()
+  record_poll(site)
+  test_exists, response = await asyncio.to_thread(check_test_exists, site, use_cache, poll_status_only)
+  ready_from_cache = test_exists and use_cache
+
+  if not test_exists and not (resume and response["status"] == "IN_PROGRESS"):
+    await asyncio.to_thread(start_new_test, site)
+
+  if not test_exists and checkpoint_journal is not None:
+    checkpoint_journal.record(site, "polling")
+
+  while not test_exists:
+    delay = next_poll_delay(response, monotonic() - started)
+    logger.info("Test for %s is not ready, sleeping %.0f seconds and trying again", site, delay, extra={"site": site})
+    with timed("sleep"):
+      await asyncio.sleep(delay)
+    record_poll(site)
+    test_exists, response = await asyncio.to_thread(check_test_exists, site, False, poll_status_only)
+
+    logger.debug("Poll response", extra={"site": site, "response": response})
+
+    if response["status"] == "ERROR":
+      logger.error("Test for %s resulted in an error", site, extra={"site": site, "status_message": response["statusMessage"]})
+      raise SystemError(response["statusMessage"])
+
+  if poll_status_only:
+    response = await asyncio.to_thread(get_full_results, site, response, ready_from_cache)
+
+  return response
+
+# Short names for the certificate name attributes, keyed by their OID
+NAME_ATTRIBUTES = {
+  "2.5.4.3": "CN",
+  "2.5.4.5": "SERIALNUMBER",
+  "2.5.4.6": "C",
+  "2.5.4.7": "L",
+  "2.5.4.8": "ST",
+  "2.5.4.10": "O",
+  "2.5.4.11": "OU",
+  "1.2.840.113549.1.9.1": "EMAILADDRESS",
+}
+SUBJECT_ALT_NAME_OID = "2.5.29.17"
+
+def der_items(data: bytes, start: int, end: int) -> Iterator[tuple[int, int, int]]:
+  """Walks the DER elements between start and end, yielding the tag and the bounds of each value"""
+  pos = start
+  while pos < end:
+    tag = data[pos]
+    length = data[pos + 1]
+    pos += 2
+    if length & 0x80:
+      num_bytes = length & 0x7f
+      length = int.from_bytes(data[pos:pos + num_bytes], "big")
+      pos += num_bytes
+    yield tag, pos, pos + length
+    pos += length
+
+def decode_oid(value: bytes) -> str:
+  """Decodes a DER object identifier into dotted form"""
+  parts = [value[0] // 40, value[0] % 40]
+  num = 0
+  for byte in value[1:]:
+    num = (num << 7) | (byte & 0x7f)
+    if not byte & 0x80:
+      parts.append(num)
+      num = 0
+  return ".".join(str(p) for p in parts)
+
+def decode_der_time(tag: int, value: bytes) -> int:
+  """Decodes a UTCTime or GeneralizedTime into milliseconds since the epoch, the same as SSL Labs reports"""
+  text = value.decode("ascii").rstrip("Z")
+  if tag == 0x17:
+    # UTCTime only has two digit years, which cover 1950 to 2049
+    year = int(text[:2])
+    text = str(1900 + year if year >= 50 else 2000 + year) + text[2:]
+  dt = datetime.datetime.strptime(text[:14], "%Y%m%d%H%M%S").replace(tzinfo=datetime.timezone.utc)
+  return int(dt.timestamp()) * 1000
+
+def decode_der_name(data: bytes, start: int, end: int) -> str:
+  """Decodes a certificate name into the "CN=...,O=...,C=..." form SSL Labs uses"""
+  rdns = []
+  for _, set_start, set_end in der_items(data, start, end):
+    for _, attr_start, attr_end in der_items(data, set_start, set_end):
+      (_, oid_start, oid_end), (_, val_start, val_end) = der_items(data, attr_start, attr_end)
+      oid = decode_oid(data[oid_start:oid_end])
+      rdns.append(f"{NAME_ATTRIBUTES.get(oid, oid)}={data[val_start:val_end].decode('utf-8', 'replace')}")
+  # Names are stored most general first but written most specific first
+  return ",".join(reversed(rdns))
+
+def parse_der_certificate(der: bytes) -> dict:
+  """Pulls the fields the reports use out of a DER encoded certificate.
+
+  The stdlib only decodes certificates it has verified, and the sites we
+  check can have expired or self-signed ones, so this walks just enough of
+  the X.509 structure to get the names, validity dates and serial number.
+  """
+  _, cert_start, cert_end = next(der_items(der, 0, len(der)))
+  _, tbs_start, tbs_end = next(der_items(der, cert_start, cert_end))
+  fields = list(der_items(der, tbs_start, tbs_end))
+
+  # The version is an optional explicitly tagged field in front of the serial number
+  if fields[0][0] == 0xa0:
+    fields = fields[1:]
+  serial, _, issuer, validity, subject = fields[:5]
+
+  (nb_tag, nb_start, nb_end), (na_tag, na_start, na_end) = der_items(der, validity[1], validity[2])
+  cert = {
+    "subject": decode_der_name(der, subject[1], subject[2]),
+    "issuerSubject": decode_der_name(der, issuer[1], issuer[2]),
+    "serialNumber": der[serial[1]:serial[2]].hex(),
+    "altNames": [],
+    "notBefore": decode_der_time(nb_tag, der[nb_start:nb_end]),
+    "notAfter": decode_der_time(na_tag, der[na_start:na_end]),
+    "sha1Hash": hashlib.sha1(der).hexdigest(),
+  }
+
+  for tag, ext_start, ext_end in fields[5:]:
+    # Extensions are wrapped in an explicit [3] tag
+    if tag != 0xa3:
+      continue
+    _, exts_start, exts_end = next(der_items(der, ext_start, ext_end))
+    for _, start, end in der_items(der, exts_start, exts_end):
+      ext = list(der_items(der, start, end))
+      if decode_oid(der[ext[0][1]:ext[0][2]]) != SUBJECT_ALT_NAME_OID:
+        continue
+      # The last item is the OCTET STRING wrapping the list of names
+      _, names_start, names_end = next(der_items(der, ext[-1][1], ext[-1][2]))
+      for name_tag, name_start, name_end in der_items(der, names_start, names_end):
+        # Only dNSName entries, which are what SSL Labs lists
+        if name_tag == 0x82:
+          cert["altNames"].append(der[name_start:name_end].decode("ascii"))
+
+  return cert
+
+def cert_matches_host(site: str, names: list[str]) -> bool:
+  """Checks if any of the certificate names cover the site, allowing a wildcard in the left-most label"""
+  for name in names:
+    name = name.lower()
+    if name == site:
+      return True
+    if name.startswith("*.") and "." in site and site.split(".", 1)[1] == name[2:]:
+      return True
+  return False
+
+async def probe_endpoint(site: str, ip: str) -> dict:
+  """Does a TLS handshake with one address of the site and returns an endpoint shaped like the SSL Labs one"""
+  # We want the certificate even if it wouldn't pass verification, so nothing is checked during the handshake
+  context = ssl.create_default_context()
+  context.check_hostname = False
+  context.verify_mode = ssl.CERT_NONE
+
+  reader, writer = await asyncio.wait_for(
+    asyncio.open_connection(ip, tls_probe_port, ssl=context, server_hostname=site),
+    timeout=CONNECT_TIMEOUT
+  )
+  try:
+    ssl_object = writer.get_extra_info("ssl_object")
+    der = ssl_object.getpeercert(binary_form=True)
+    protocol = ssl_object.version()
+  finally:
+    # Nothing else is sent, so drop the connection rather than wait on a close_notify the server may never answer
+    writer.transport.abort()
+
+  cert = parse_der_certificate(der)
+  now = time.time() * 1000
+  has_warnings = not cert_matches_host(site, cert["altNames"]) or not cert["notBefore"] <= now <= cert["notAfter"]
+
+  return {
+    "ipAddress": ip,
+    "statusMessage": "Ready",
+    # A handshake alone isn't enough to give an SSL Labs style grade
+    "grade": "N/A",
+    "hasWarnings": has_warnings,
+    "details": {"cert": cert, "protocol": protocol},
+  }
+
+async def probe_site(site: str) -> dict:
+  """Handshakes with every A/AAAA address of the site at once and returns a response shaped like a READY /analyze result"""
+  loop = asyncio.get_running_loop()
+  addr_info = await loop.getaddrinfo(site, tls_probe_port, type=socket.SOCK_STREAM)
+  ips = list(dict.fromkeys(info[4][0] for info in addr_info))
+
+  endpoints = []
+  probes = await asyncio.gather(*(probe_endpoint(site, ip) for ip in ips), return_exceptions=True)
+  for ip, probe in zip(ips, probes):
+    if isinstance(probe, Exception):
+      logger.warning("Unable to handshake with %s at %s", site, ip, extra={"site": site, "error": str(probe)})
+      continue
+    endpoints.append(probe)
+
+  if not endpoints:
+    raise SystemError(f"Unable to handshake with any address of {site}")
+
+  return {"host": site, "port": tls_probe_port, "status": "READY", "endpoints": endpoints}
+
+class EndpointResult:
+  """One endpoint in the default report. Dates are milliseconds since the epoch, the same as SSL Labs reports."""
+
+  __slots__ = ("ip", "grade", "warnings", "cert_subject", "cert_alt_names", "cert_not_before", "cert_not_after")
+
+  def __init__(
+    self, ip: str, grade: str | None, warnings: bool, cert_subject: str,
+    cert_alt_names: Iterable[str], cert_not_before: int, cert_not_after: int
+  ) -> None:
+    self.ip = ip
+    self.grade = grade
+    self.warnings = warnings
+    self.cert_subject = cert_subject
+    self.cert_alt_names = tuple(cert_alt_names)
+    self.cert_not_before = int(cert_not_before)
+    self.cert_not_after = int(cert_not_after)
+
+  @classmethod
+  def from_response(cls, endpoint: dict) -> "EndpointResult":
+    """Pulls the report fields out of an endpoint in an API response"""
+    cert = endpoint["details"]["cert"]
+    return cls(
+      endpoint["ipAddress"], endpoint["grade"], endpoint["hasWarnings"],
+      cert["subject"], cert["altNames"], cert["notBefore"], cert["notAfter"]
+    )
+
+  @classmethod
+  def from_dict(cls, data: dict) -> "EndpointResult":
+    return cls(**data)
+
+  def to_dict(self) -> dict:
+    data = {name: getattr(self, name) for name in self.__slots__}
+    data["cert_alt_names"] = list(self.cert_alt_names)
+    return data
+
+class FieldsEndpointResult:
+  """One endpoint in an --endpoint_fields report, the values are in the same order as the fields"""
+
+  __slots__ = ("fields", "values")
+
+  # One tuple of field names shared by every endpoint with the same fields
+  field_sets = {}
+
+  def __init__(self, fields: Iterable[str], values: Iterable[object]) -> None:
+    fields = tuple(fields)
+    self.fields = self.field_sets.setdefault(fields, fields)
+    self.values = tuple(values)
+    if len(self.values) != len(self.fields):
+      raise ValueError(f"Got {len(self.values)} values for {len(self.fields)} endpoint fields")
+
+  @classmethod
+  def from_response(cls, endpoint: dict) -> "FieldsEndpointResult":
+    """Looks the --endpoint_fields paths up in an endpoint in an API response"""
+    return cls(endpoint_fields, (f.get(endpoint) for f in compiled_endpoint_fields))
+
+  @classmethod
+  def from_dict(cls, data: dict) -> "FieldsEndpointResult":
+    return cls(data.keys(), data.values())
+
+  def to_dict(self) -> dict:
+    return dict(zip(self.fields, self.values))
+
+  def items(self) -> Iterator[tuple[str, object]]:
+    return zip(self.fields, self.values)
+
+class HostResult:
+  """The parsed results for one site"""
+
+  __slots__ = ("host", "endpoints")
+
+  def __init__(self, host: str, endpoints: list[EndpointResult | FieldsEndpointResult]) -> None:
+    self.host = host
+    self.endpoints = endpoints
+
+  @classmethod
+  def from_dict(cls, data: dict) -> "HostResult":
+    """Rebuilds results saved with to_dict(), in the cache, journal or work queue"""
+    endpoint_class = FieldsEndpointResult if use_end_point_fields else EndpointResult
+    return cls(data["host"], [endpoint_class.from_dict(ep) for ep in data["endpoints"]])
+
+  def to_dict(self) -> dict:
+    """Returns the results as plain JSON serializable types"""
+    return {"host": self.host, "endpoints": [ep.to_dict() for ep in self.endpoints]}
+
+MS_PER_DAY = 86400 * 1000
+
+@functools.lru_cache(maxsize=4096)
+def utc_date(day: int) -> str:
+  """Formats a count of days since the epoch as YYYY-MM-DD. Certificates in a run share a few hundred distinct days at most."""
+  return (datetime.date(1970, 1, 1) + datetime.timedelta(days=day)).isoformat()
+
+class ValidityWindows:
+  """Validity windows of a batch of certificates, worked out for all of them at once.
+
+  Takes the notBefore and notAfter dates in milliseconds since the epoch and
+  works out the dates as YYYY-MM-DD in UTC, the days left until expiry, the
+  length of the validity period in days, and whether each certificate has
+  expired or isn't valid yet. With NumPy each of these is an array built in
+  a single vectorized pass. Without it they're lists, with the date strings
+  looked up per day rather than formatted for every certificate.
+  """
+
+  __slots__ = ("not_before_dates", "not_after_dates", "days_remaining", "validity_days", "expired", "not_yet_valid")
+
+  def __init__(self, not_before: list[int], not_after: list[int], now: float | None = None) -> None:
+    now_ms = (time.time() if now is None else now) * 1000
+
+    if numpy is not None:
+      before = numpy.array(not_before, dtype=numpy.int64)
+      after = numpy.array(not_after, dtype=numpy.int64)
+      # datetime64 has no time zone, so these are the UTC dates. They're made
+      # plain strings in one go, as reading a NumPy string array an item at a time is slow.
+      self.not_before_dates = numpy.datetime_as_string(before.astype("datetime64[ms]"), unit="D").tolist()
+      self.not_after_dates = numpy.datetime_as_string(after.astype("datetime64[ms]"), unit="D").tolist()
+      self.days_remaining = (after - now_ms) / MS_PER_DAY
+      self.validity_days = (after - before) / MS_PER_DAY
+      self.expired = after < now_ms
+      self.not_yet_valid = before > now_ms
+      return
+
+    self.not_before_dates = [utc_date(ms // MS_PER_DAY) for ms in not_before]
+    self.not_after_dates = [utc_date(ms // MS_PER_DAY) for ms in not_after]
+    self.days_remaining = [(ms - now_ms) / MS_PER_DAY for ms in not_after]
+    self.validity_days = [(a - b) / MS_PER_DAY for b, a in zip(not_before, not_after)]
+    self.expired = [ms < now_ms for ms in not_after]
+    self.not_yet_valid = [ms > now_ms for ms in not_before]
+
+class ExpiryIndex:
+  """Min-heap of every certificate seen, keyed by its notAfter date.
+
+  Entries are (not_after, host, ip, subject, not_before) tuples. Adding a host again
+  replaces all of its earlier entries, which are left in the heap and skipped
+  until there are enough of them to be worth rebuilding it without them. An
+  entry that is already live isn't pushed again.
+  """
+
+  # Fields holding the validity dates when --endpoint_fields is in use
+  NOT_AFTER_FIELD = "details.cert.notAfter"
+  NOT_BEFORE_FIELD = "details.cert.notBefore"
+
+  def __init__(self) -> None:
+    self.heap = []
+    # The live entries for each host
+    self.current = {}
+
+  def add(self, results: HostResult) -> None:
+    """Indexes the certificates of every endpoint of a site, replacing any earlier ones"""
+    previous = self.current.get(results.host, ())
+    entries = set()
+    for endpoint in results.endpoints:
+      entry = self.endpoint_entry(results.host, endpoint)
+      if entry is not None and entry not in entries:
+        entries.add(entry)
+        if entry not in previous:
+          heapq.heappush(self.heap, entry)
+    self.current[results.host] = entries
+
+    live = sum(len(e) for e in self.current.values())
+    if len(self.heap) > 2 * live + 1000:
+      self.heap = [entry for entries in self.current.values() for entry in entries]
+      heapq.heapify(self.heap)
+
+  def endpoint_entry(self, host: str, endpoint: EndpointResult | FieldsEndpointResult) -> tuple | None:
+    if isinstance(endpoint, EndpointResult):
+      return (endpoint.cert_not_after, host, endpoint.ip, endpoint.cert_subject, endpoint.cert_not_before)
+
+    fields = dict(endpoint.items())
+    not_after = fields.get(self.NOT_AFTER_FIELD)
+    if not isinstance(not_after, int):
+      return None
+    not_before = fields.get(self.NOT_BEFORE_FIELD)
+    if not isinstance(not_before, int):
+      not_before = not_after
+    return (not_after, host, fields.get("ipAddress"), fields.get("details.cert.subject"), not_before)
+
+  def expiring_within(self, days: float, now: float | None = None) -> list[tuple]:
+    """Returns every live entry expiring within days of now, soonest first.
+
+    Walks the heap from the root and only looks at the children of entries
+    that are inside the cutoff, so it takes O(k log k) for k matches rather
+    than visiting the whole heap.
+    """
+    now = time.time() if now is None else now
+    cutoff = (now + days * 86400) * 1000
+    found = []
+    # A host that went back to an earlier certificate can have a stale copy of a live entry in the heap too
+    seen = set()
+    if not self.heap:
+      return found
+
+    candidates = [(self.heap[0], 0)]
+    while candidates:
+      entry, i = heapq.heappop(candidates)
+      if entry[0] > cutoff:
+        break
+      if entry not in seen and entry in self.current.get(entry[1], ()):
+        seen.add(entry)
+        found.append(entry)
+      for child in (2 * i + 1, 2 * i + 2):
+        if child < len(self.heap):
+          heapq.heappush(candidates, (self.heap[child], child))
+    return found
+
+  def alerts(self, thresholds: list[int], now: float | None = None) -> list[dict]:
+    """Returns an alert for every certificate within the largest threshold, tagged with the tightest threshold it's inside"""
+    now = time.time() if now is None else now
+    entries = self.expiring_within(max(thresholds), now)
+    windows = ValidityWindows([e[4] for e in entries], [e[0] for e in entries], now)
+
+    alerts = []
+    for i, (not_after, host, ip, subject, _) in enumerate(entries):
+      days_left = float(windows.days_remaining[i])
+      alerts.append({
+        "host": host,
+        "ip": ip,
+        "subject": subject,
+        "not_after": datetime.datetime.fromtimestamp(not_after / 1000, datetime.timezone.utc).isoformat(),
+        "days_left": round(days_left, 1),
+        "threshold": min(t for t in thresholds if days_left <= t),
+        "expired": bool(windows.expired[i]),
+      })
+    return alerts
+
+def write_expiry_alerts() -> None:
+  """Writes the alerts from the expiry index to expiry_alerts_path"""
+  alerts = expiry_index.alerts(expiry_thresholds)
+
+  stream = sys.stdout if expiry_alerts_path == "-" else open(expiry_alerts_path, "w", encoding="utf-8")
+  try:
+    for alert in alerts:
+      stream.write(json.dumps(alert) + "\n")
+  finally:
+    if stream is not sys.stdout:
+      stream.close()
+
+  counts = {threshold: sum(1 for alert in alerts if alert["threshold"] <= threshold) for threshold in sorted(expiry_thresholds)}
+  logger.info("Certificates close to expiring", extra={"expiring_within_days": counts})
+
+def parse_response(response: dict) -> HostResult:
+  """Takes full test result output and pulls relevant fields out. Can be used with either hardcoded fields or dynamic endpoint fields"""
+  endpoint_class = FieldsEndpointResult if use_end_point_fields else EndpointResult
+  return HostResult(response["host"], [endpoint_class.from_response(ep) for ep in response["endpoints"]])
+
+def create_dynamic_endpoint_output(results: HostResult) -> list[str]:
+  """Generates formatted output for dynamic end point fields"""
+
+  output_arr = [
+    f"{results.host}:",
+    "  Public Endpoints:"
+  ]
+
+  for endpoint in results.endpoints:
+    for field, value in endpoint.items():
+      output_arr.append(f"    {field}: {value}")
+  
+  return output_arr
+
+
+def create_email_style_output(results: HostResult, windows: ValidityWindows | None = None, offset: int = 0) -> list[str]:
+  """Creates formatted output and returns it as an array. The dates come from windows, starting at offset, if given."""
+  if windows is None:
+    # Windows for just this site, so any offset into a batch doesn't apply
+    windows = ValidityWindows([ep.cert_not_before for ep in results.endpoints], [ep.cert_not_after for ep in results.endpoints])
+    offset = 0
+
+  output_arr = [
+    f"{results.host}:",
+    "  Public Endpoints:"
+  ]
+  for i, endpoint in enumerate(results.endpoints, offset):
+    output_arr.append(f"    IP Address: {endpoint.ip}")
+    output_arr.append(f"    Grade     : {endpoint.grade}")
+    output_arr.append(f"    Warnings  : {str(endpoint.warnings)}")
+    output_arr.append(f"    SSL Cert  :")
+    output_arr.append(f"        Subject Name    : {endpoint.cert_subject.split('=')[1]}")
+    output_arr.append(f"        Alternative Name: {' '.join(endpoint.cert_alt_names)}")
+    output_arr.append(f"        Not Valid Before: {windows.not_before_dates[i]}")
+    output_arr.append(f"        Not Valid After : {windows.not_after_dates[i]}")
+  
+  return output_arr
+
+def format_results(results: HostResult, windows: ValidityWindows | None = None, offset: int = 0) -> list[str]:
+  """Formats the results for a single site in the output style in use"""
+  if use_end_point_fields:
+    return create_dynamic_endpoint_output(results)
+  return create_email_style_output(results, windows, offset)
+
+def format_results_batch(batch: list[HostResult]) -> list[str]:
+  """Formats the results for several sites, working out the certificate dates for all of them in one pass.
+
+  A site whose results can't be formatted is logged and left out, so it
+  doesn't take the rest of the batch with it.
+  """
+  started = monotonic()
+  windows = None
+  if not use_end_point_fields:
+    endpoints = [endpoint for results in batch for endpoint in results.endpoints]
+    try:
+      windows = ValidityWindows([ep.cert_not_before for ep in endpoints], [ep.cert_not_after for ep in endpoints])
+    except Exception as e:
+      # Each site works out its own dates instead, so only the bad one fails
+      logger.warning("Unable to work out certificate dates for the batch", extra={"error": str(e)})
+  # The shared date pass is split evenly between the sites
+  shared = (monotonic() - started) / len(batch)
+
+  lines = []
+  offset = 0
+  for results in batch:
+    started = monotonic()
+    try:
+      lines.extend(format_results(results, windows, offset))
+    except Exception as e:
+      logger.error("Unable to format results for %s", results.host, extra={"site": results.host, "error": repr(e)})
+    offset += len(results.endpoints)
+    get_site_timing(results.host).add("format", monotonic() - started + shared)
+    finish_site_timing(results.host)
+  return lines
+
+class ResultWriter:
+  """Writes each site's results as soon as they are ready.
+
+  In completion order results are written the moment they arrive. In input
+  order they are held until every site before them has been written, and
+  sites may only be started while they are within buffer_size of the oldest
+  unwritten one, which bounds how many results are held at once.
+
+  Results ready to be written are formatted together in batches of up to
+  WRITE_BATCH_SIZE, and none waits more than WRITE_FLUSH_INTERVAL seconds.
+  Call close() to write out the last batch.
+  """
+
+  def __init__(self, stream, order: str = "input", buffer_size: int = reorder_buffer_size) -> None:
+    self.stream = stream
+    self.order = order
+    self.buffer_size = buffer_size
+    # Finished results waiting on an earlier site, keyed by input index
+    self.pending = {}
+    self.next_index = 0
+    self.condition = None
+    # Results ready to be written in the next batch
+    self.batch = []
+    self.batch_lock = threading.Lock()
+    self.flush_timer = None
+    # An error from a flush on the timer thread, raised again by the next write or close
+    self.flush_error = None
+
+  def get_condition(self) -> asyncio.Condition:
+    # Created on first use so it belongs to the running event loop
+    if self.condition is None:
+      self.condition = asyncio.Condition()
+    return self.condition
+
+  def has_room(self, index: int) -> bool:
+    """Checks if the site at index can be started without overflowing the reorder buffer"""
+    return self.order == "completion" or index - self.next_index < self.buffer_size
+
+  async def wait_for_room(self, index: int) -> None:
+    """Waits until the site at index can be started"""
+    condition = self.get_condition()
+    async with condition:
+      await condition.wait_for(lambda: self.has_room(index))
+
+  async def emit(self, index: int, results: HostResult | None) -> None:
+    """Hands over the results for the site at index, or None if it failed"""
+    condition = self.get_condition()
+    async with condition:
+      self.put(index, results)
+      condition.notify_all()
+
+  def put(self, index: int, results: HostResult | None) -> None:
+    """Synchronous version of emit for callers outside the event loop"""
+    if self.order == "completion":
+      self.write(results)
+      self.next_index += 1
+    else:
+      self.pending[index] = results
+      while self.next_index in self.pending:
+        self.write(self.pending.pop(self.next_index))
+        self.next_index += 1
+
+  def write(self, results: HostResult | None) -> None:
+    self.raise_flush_error()
+    if results is None:
+      return
+    if expiry_index is not None:
+      expiry_index.add(results)
+
+    with self.batch_lock:
+      self.batch.append(results)
+      full = len(self.batch) >= WRITE_BATCH_SIZE
+      if not full and self.flush_timer is None:
+        # Makes sure a result isn't held back for long when the next ones are slow to come
+        self.flush_timer = threading.Timer(WRITE_FLUSH_INTERVAL, self.timed_flush)
+        self.flush_timer.daemon = True
+        self.flush_timer.start()
+    if full:
+      self.flush()
+
+  def flush(self) -> None:
+    """Writes out the results in the current batch"""
+    with self.batch_lock:
+      batch = self.batch
+      self.batch = []
+      if self.flush_timer is not None:
+        self.flush_timer.cancel()
+        self.flush_timer = None
+      if batch:
+        self.stream.write("\n".join(format_results_batch(batch)) + "\n")
+        self.stream.flush()
+
+  def timed_flush(self) -> None:
+    # Runs on the timer thread, where an exception would otherwise be lost
+    try:
+      self.flush()
+    except Exception as e:
+      self.flush_error = e
+
+  def raise_flush_error(self) -> None:
+    if self.flush_error is not None:
+      error, self.flush_error = self.flush_error, None
+      raise error
+
+  def close(self) -> None:
+    """Writes out anything still waiting to be written"""
+    self.raise_flush_error()
+    self.flush()
+
+async def assess_site(site: str, resume: bool = False, force: bool = False) -> dict:
+  """Gets the full SSL Labs assessment for a site, starting a new one if needed. With force a new one is always started."""
+  # The first /analyze call can kick off an assessment, so hold a slot for the whole run of the site
+  with timed("queued"):
+    await assessment_capacity.acquire()
+  try:
+    with timed("assessment"):
+      if (force_new_test or force) and not resume:
+        logger.info("Starting new test for %s now", site, extra={"site": site})
+        new_test = await asyncio.to_thread(start_new_test, site)
+        logger.debug("New test response", extra={"site": site, "response": new_test})
+
+      return await async_get_test_results(site, resume)
+  finally:
+    assessment_capacity.release()
+
+def lookup_finished_result(site: str) -> tuple[HostResult | None, bool]:
+  """Looks for results for the site that don't need any scanning, in the resume journal and then the local cache.
+
+  Returns the results if found, and whether the site was part way through an
+  assessment when the journal was last written.
+  """
+  global local_cache_hits, resumed_sites
+
+  previous = resume_states.get(site)
+  if previous is not None and previous["state"] == "done" and previous.get("fields") == current_fields_key():
+    logger.info("Using results for %s from the journal", site, extra={"site": site})
+    resumed_sites += 1
+    return HostResult.from_dict(previous["result"]), False
+  # Sites that were in the middle of an assessment go straight back to polling it
+  resuming = previous is not None and previous["state"] in ("started", "polling")
+
+  if result_cache is not None and not force_new_test:
+    cached = result_cache.get(site)
+    if cached is not None:
+      logger.info("Using locally cached results for %s", site, extra={"site": site})
+      local_cache_hits += 1
+      if checkpoint_journal is not None:
+        checkpoint_journal.record(site, "done", cached)
+      return cached, False
+
+  return None, resuming
+
+async def site_fingerprint(site: str) -> str | None:
+  """Fingerprints the site's addresses and the leaf certificate each one serves, from a quick TLS handshake with all of them.
+
+  Returns None if the site can't be reached, so it's treated as changed.
+  """
+  try:
+    response = await probe_site(site)
+  except Exception as e:
+    logger.info("Unable to fingerprint %s, it will be reassessed", site, extra={"site": site, "error": str(e)})
+    return None
+
+  parts = sorted(
+    f"{ep['ipAddress']} {ep['details']['cert']['serialNumber']} {ep['details']['cert']['sha1Hash']}"
+    for ep in response["endpoints"]
+  )
+  return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+async def lookup_unchanged_result(site: str) -> tuple[HostResult | None, str | None]:
+  """In incremental mode, checks if the site still matches its cached result.
+
+  Returns the cached results if it does, and the site's current fingerprint
+  to store with a new result if it doesn't.
+  """
+  global unchanged_sites
+
+  fingerprint = await site_fingerprint(site)
+  previous = result_cache.get_fingerprinted(site, incremental_max_age)
+  if fingerprint is not None and previous is not None and previous[1] == fingerprint:
+    logger.info("%s is unchanged, using the cached results", site, extra={"site": site})
+    unchanged_sites += 1
+    if checkpoint_journal is not None:
+      checkpoint_journal.record(site, "done", previous[0])
+    return previous[0], fingerprint
+
+  return None, fingerprint
+
+def record_site_result(site: str, results: HostResult, response: dict, fingerprint: str | None = None) -> None:
+  """Saves the results for a finished site to the local cache and journal"""
+  if result_cache is not None:
+    result_cache.put(site, results, response, fingerprint)
+  if checkpoint_journal is not None:
+    checkpoint_journal.record(site, "done", results)
+
+def record_site_failure(site: str, error: Exception) -> None:
+  """Reports a site that couldn't be scanned"""
+  logger.error("Error getting test results for %s", site, extra={"site": site, "error": str(error)})
+  if checkpoint_journal is not None:
+    checkpoint_journal.record(site, "failed")
+
+async def scan_site(site: str) -> HostResult | None:
+  """Runs the full assessment for a single site and returns the parsed results, or None if it failed"""
+  with timing_for(site):
+    results = await scan_site_phases(site)
+  # Finished sites' timings are handed on once they are formatted
+  if results is None:
+    finish_site_timing(site)
+  return results
+
+async def scan_site_phases(site: str) -> HostResult | None:
+  """The steps of scan_site(), with the site's timing already in place"""
+  # Everything, including the journal and cache, is inside here so a problem only fails this site
+  try:
+    results, resuming = lookup_finished_result(site)
+    if results is not None:
+      return results
+
+    fingerprint = None
+    if incremental_mode and not resuming:
+      results, fingerprint = await lookup_unchanged_result(site)
+      if results is not None:
+        return results
+
+    if checkpoint_journal is not None:
+      checkpoint_journal.record(site, "started")
+
+    if scan_backend == "tls":
+      response = await probe_site(site)
+    else:
+      # In incremental mode a site only gets here if it changed, so the old assessment is no good
+      response = await assess_site(site, resuming, force=incremental_mode)
+    with timed("parse"):
+      results = parse_response(response)
+
+    record_site_result(site, results, response, fingerprint)
+  except Exception as e:
+    record_site_failure(site, e)
+    return None
+
+  return results
+
+class PendingAssessment:
+  """A site the pipelined runner is waiting on"""
+
+  __slots__ = ("index", "site", "started", "next_poll", "response", "ready_from_cache")
+
+  def __init__(self, index: int, site: str, response: dict, ready_from_cache: bool) -> None:
+    self.index = index
+    self.site = site
+    self.started = monotonic()
+    self.response = response
+    self.ready_from_cache = ready_from_cache
+    self.next_poll = self.started + next_poll_delay(response, 0)
+
+def begin_assessment(index: int, site: str, resuming: bool) -> PendingAssessment:
+  """Submits the first request for a site in the pipelined runner. The caller must already hold an assessment slot."""
+  if checkpoint_journal is not None:
+    checkpoint_journal.record(site, "started")
+
+  if force_new_test and not resuming:
+    logger.info("Starting new test for %s now", site, extra={"site": site})
+    start_new_test(site)
+
+  record_poll(site)
+  test_exists, response = check_test_exists(site, use_cache, poll_status_only)
+  if not test_exists and not (resuming and response["status"] == "IN_PROGRESS"):
+    start_new_test(site)
+  if not test_exists and checkpoint_journal is not None:
+    checkpoint_journal.record(site, "polling")
+
+  return PendingAssessment(index, site, response, test_exists and use_cache)
+
+def harvest_assessment(pending: PendingAssessment) -> HostResult | None:
+  """Checks on a pending site. Returns the parsed results once it is READY, otherwise None."""
+  if pending.response["status"] != "READY":
+    record_poll(pending.site)
+    test_exists, pending.response = check_test_exists(pending.site, status_only=poll_status_only)
+
+    logger.debug("Poll response", extra={"site": pending.site, "response": pending.response})
+
+    if pending.response["status"] == "ERROR":
+      raise SystemError(pending.response["statusMessage"])
+
+    if not test_exists:
+      pending.next_poll = monotonic() + next_poll_delay(pending.response, monotonic() - pending.started)
+      return None
+
+  response = pending.response
+  if poll_status_only:
+    response = get_full_results(pending.site, response, pending.ready_from_cache)
+  get_site_timing(pending.site).add("assessment", monotonic() - pending.started)
+
+  with timed("parse"):
+    results = parse_response(response)
+  record_site_result(pending.site, results, response)
+  return results
+
+def pipelined_runner(sites: Iterable[str], writer: ResultWriter) -> None:
+  """Starts assessments for as many sites as the API allows, then round-robins status checks across all of them.
+
+  Everything runs from this one loop without threads. New sites are started
+  whenever a slot frees up, so the remote assessments overlap as much as the
+  API capacity lets them.
+  """
+  site_iter = iter(sites)
+  next_index = 0
+  next_site = None
+  exhausted = False
+  pending = deque()
+
+  try:
+    get_info()
+  except Exception as e:
+    logger.warning(
+      "Unable to get assessment limits from /info, starting with %d", assessment_capacity.max_assessments, extra={"error": str(e)}
+    )
+
+  while pending or not exhausted:
+    # Submit phase: start as many new sites as there are free slots for
+    while not exhausted:
+      if next_site is None:
+        site = next(site_iter, None)
+        if site is None:
+          exhausted = True
+          break
+        if site is NO_SITE_YET:
+          break
+        next_site = (next_index, site)
+        next_index += 1
+
+      index, site = next_site
+      timing = get_site_timing(site)
+      if not writer.has_room(index):
+        break
+
+      try:
+        results, resuming = lookup_finished_result(site)
+      except Exception as e:
+        record_site_failure(site, e)
+        finish_site_timing(site)
+        writer.put(index, None)
+        next_site = None
+        continue
+      if results is not None:
+        writer.put(index, results)
+        next_site = None
+        continue
+
+      if not assessment_capacity.try_acquire():
+        break
+      next_site = None
+      timing.add("queued", monotonic() - timing.created)
+
+      try:
+        with timing_for(site):
+          pending.append(begin_assessment(index, site, resuming))
+      except Exception as e:
+        assessment_capacity.release()
+        record_site_failure(site, e)
+        finish_site_timing(site)
+        writer.put(index, None)
+
+    # Harvest phase: check every site that is due once
+    for _ in range(len(pending)):
+      item = pending.popleft()
+      if monotonic() < item.next_poll and item.response["status"] != "READY":
+        pending.append(item)
+        continue
+
+      try:
+        with timing_for(item.site):
+          results = harvest_assessment(item)
+      except Exception as e:
+        assessment_capacity.release()
+        record_site_failure(item.site, e)
+        finish_site_timing(item.site)
+        writer.put(item.index, None)
+        continue
+
+      if results is None:
+        pending.append(item)
+      else:
+        assessment_capacity.release()
+        writer.put(item.index, results)
+
+    # Sleep until the next site is due, but wake up now and then to see if a slot has freed up
+    if pending:
+      wait = min(item.next_poll for item in pending) - monotonic()
+      if not exhausted:
+        wait = min(wait, 1)
+      if wait > 0:
+        sleep(wait)
+    elif not exhausted:
+      sleep(1)
+
+async def async_runner(sites: Iterable[str], writer: ResultWriter) -> None:
+  """Assesses up to max_concurrency sites at once and hands each result to the writer as it finishes"""
+
+  # Blocking API calls are handed off to threads, so size the pool to match the concurrency limit
+  loop = asyncio.get_running_loop()
+  loop.set_default_executor(ThreadPoolExecutor(max_workers=max_concurrency))
+
+  site_iter = enumerate(sites)
+  next_lock = asyncio.Lock()
+
+  async def next_site() -> tuple[int, str] | None:
+    # All workers pull from the same iterator, so each site is only handed out once.
+    # Reading the next site can block on a slow file or pipe, so it's done off the event loop.
+    async with next_lock:
+      return await asyncio.to_thread(next, site_iter, None)
+
+  async def worker() -> None:
+    while (item := await next_site()) is not None:
+      index, site = item
+      timing = get_site_timing(site)
+      await writer.wait_for_room(index)
+      timing.add("queued", monotonic() - timing.created)
+      await writer.emit(index, await scan_site(site))
+
+  await asyncio.gather(*(worker() for _ in range(max_concurrency)))
+
+class HashRing:
+  """Consistent hash ring that maps sites to workers.
+
+  Each worker gets HASH_RING_REPLICAS points on the ring and a site goes to
+  the worker owning the next point after the site's hash. The same site
+  always lands on the same worker, and changing the number of workers only
+  moves the sites next to the points that were added or removed.
+  """
+
+  def __init__(self, nodes: int, replicas: int = HASH_RING_REPLICAS) -> None:
+    points = sorted((self.hash_key(f"worker-{node}-{replica}"), node) for node in range(nodes) for replica in range(replicas))
+    self.keys = [key for key, _ in points]
+    self.nodes = [node for _, node in points]
+
+  @staticmethod
+  def hash_key(value: str) -> int:
+    # Python's own hash() is randomized per process, so use a stable one
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+  def get_node(self, site: str) -> int:
+    """Returns the worker the site belongs to"""
+    i = bisect.bisect(self.keys, self.hash_key(site)) % len(self.keys)
+    return self.nodes[i]
+
+class QueueWriter(ResultWriter):
+  """Sends a worker's results back to the parent process instead of writing them"""
+
+  def __init__(self, queue, global_indexes: dict) -> None:
+    super().__init__(None, "completion")
+    self.queue = queue
+    # Maps the worker's own site numbering back to the position in the full input
+    self.global_indexes = global_indexes
+
+  def put(self, index: int, results: HostResult | None) -> None:
+    # The parent adds the time spent formatting, so the site's timing goes along with the results
+    timing = None
+    if results is not None:
+      finished = site_timings.pop(results.host, None)
+      timing = finished.to_dict() if finished is not None else None
+    self.queue.put(("result", self.global_indexes.pop(index), (results, timing)))
+
+def shard_worker(worker_id: int, args: argparse.Namespace, in_queue, out_queue) -> None:
+  """Runs in a worker process. Scans the sites sent on in_queue and sends results and statistics back on out_queue."""
+  global timing_sink
+
+  configure(args)
+  # Failed sites' timings go straight back to the parent, which keeps the summary and timing file
+  timing_sink = lambda timing: out_queue.put(("timing", worker_id, timing.to_dict()))
+
+  global_indexes = {}
+
+  def queued_sites() -> Iterator[str]:
+    local_index = 0
+    while (item := in_queue.get()) is not None:
+      global_indexes[local_index] = item[0]
+      local_index += 1
+      yield item[1]
+
+  writer = QueueWriter(out_queue, global_indexes)
+  if pipeline_mode:
+    pipelined_runner(queued_sites(), writer)
+  else:
+    asyncio.run(async_runner(queued_sites(), writer))
+
+  out_queue.put(("stats", worker_id, collect_run_stats()))
+  stop_logging()
+  out_queue.put(("done", worker_id, None))
+
+def sharded_runner(sites: Iterable[str], writer: ResultWriter) -> None:
+  """Splits the sites across worker_count processes and merges their results into the writer"""
+  args = argparse.Namespace(**vars(worker_args))
+  args.workers = 1
+  # Only the parent writes the timing file
+  args.timing_file = None
+
+  # Share one rate limit between every worker, even if no file was given for it
+  rate_limit_dir = None
+  if args.rate_limit and not args.rate_limit_db:
+    rate_limit_dir = tempfile.TemporaryDirectory()
+    args.rate_limit_db = os.path.join(rate_limit_dir.name, "rate_limit.db")
+
+  ring = HashRing(worker_count)
+  context = multiprocessing.get_context()
+  out_queue = context.Queue()
+  in_queues = [context.Queue(WORKER_QUEUE_SIZE) for _ in range(worker_count)]
+  workers = [
+    context.Process(target=shard_worker, args=(i, args, in_queues[i], out_queue), daemon=True)
+    for i in range(worker_count)
+  ]
+  for worker in workers:
+    worker.start()
+
+  # The feeder waits on this for room in the writer's reorder buffer
+  room = threading.Condition()
+  # Anything that goes wrong reading the sites, raised again once the workers have stopped
+  feed_errors = []
+
+  def feed() -> None:
+    try:
+      for index, site in enumerate(sites):
+        with room:
+          room.wait_for(lambda: writer.has_room(index))
+        in_queues[ring.get_node(site)].put((index, site))
+    except Exception as e:
+      feed_errors.append(e)
+    finally:
+      for in_queue in in_queues:
+        in_queue.put(None)
+
+  feeder = threading.Thread(target=feed, daemon=True)
+  feeder.start()
+
+  try:
+    running = set(range(worker_count))
+    while running:
+      try:
+        kind, key, value = out_queue.get(timeout=WORKER_CHECK_INTERVAL)
+      except queue.Empty:
+        # A worker that exits cleanly has already sent everything, so only a failed one is a problem
+        for i in running:
+          if workers[i].exitcode not in (None, 0):
+            raise SystemError(f"Worker {i} exited with code {workers[i].exitcode} before finishing its sites")
+        continue
+
+      if kind == "result":
+        results, timing = value
+        if timing is not None:
+          get_site_timing(results.host).merge(timing)
+        with room:
+          writer.put(key, results)
+          room.notify_all()
+      elif kind == "timing":
+        get_site_timing(value["host"]).merge(value)
+        finish_site_timing(value["host"])
+      elif kind == "stats":
+        merge_run_stats(value)
+      else:
+        running.discard(key)
+        workers[key].join()
+
+    if feed_errors:
+      raise feed_errors[0]
+  finally:
+    for worker in workers:
+      if worker.is_alive():
+        worker.terminate()
+    # Don't wait at exit to flush sites to workers that are gone
+    for in_queue in in_queues:
+      in_queue.cancel_join_thread()
+    if rate_limit_dir is not None:
+      rate_limit_dir.cleanup()
+
+class WorkQueueWriter(ResultWriter):
+  """Writes results as usual and also stores them back in the work queue"""
+
+  def __init__(self, writer: ResultWriter, owner: str, claimed: dict) -> None:
+    super().__init__(writer.stream, writer.order, writer.buffer_size)
+    self.owner = owner
+    # Maps the claim number of each site to the site
+    self.claimed = claimed
+
+  def put(self, index: int, results: HostResult | None) -> None:
+    site = self.claimed.pop(index)
+    if results is None:
+      work_queue.fail(site, self.owner)
+    else:
+      work_queue.complete(site, self.owner, results)
+    super().put(index, results)
+
+def queue_runner(sites: Iterable[str], writer: ResultWriter) -> None:
+  """Adds the sites to the work queue, then scans sites claimed from it until it's empty"""
+  added = work_queue.add(sites)
+  logger.info("Added %d sites to the work queue", added)
+
+  owner = f"{socket.gethostname()}-{os.getpid()}-{random.getrandbits(32):08x}"
+  claimed = {}
+
+  def claimed_sites(block: bool = True) -> Iterator[str]:
+    index = 0
+    while True:
+      site = work_queue.claim(owner, lease_time)
+      if site is None:
+        # Sites leased by other runs come back if their lease runs out, so keep checking until none are left
+        if work_queue.remaining() == 0:
+          return
+        # The pipelined runner has to get back to polling its own leased sites, or they never finish
+        if not block:
+          yield NO_SITE_YET
+          continue
+        sleep(QUEUE_IDLE_WAIT)
+        continue
+      claimed[index] = site
+      index += 1
+      yield site
+
+  # Keeps the leases alive while the sites are being assessed
+  stop_renewing = threading.Event()
+
+  def renew_leases() -> None:
+    while not stop_renewing.wait(lease_time / 3):
+      work_queue.renew(owner, lease_time)
+
+  renewer = threading.Thread(target=renew_leases, daemon=True)
+  renewer.start()
+  try:
+    queue_writer = WorkQueueWriter(writer, owner, claimed)
+    if pipeline_mode:
+      pipelined_runner(claimed_sites(block=False), queue_writer)
+    else:
+      asyncio.run(async_runner(claimed_sites(), queue_writer))
+    queue_writer.close()
+  finally:
+    stop_renewing.set()
+    renewer.join()
+    work_queue.close()
+
+def runner(sites: Iterable[str]) -> None:
+  """Runs SSL assesment against list of sites passed in"""
+  global timing_stream
+
+  # Certificates from earlier runs go in first so this run's results replace them
+  if expiry_index is not None and result_cache is not None:
+    for results in result_cache.all_results():
+      expiry_index.add(results)
+
+  stream = open(output_path, "w", encoding="utf-8") if output_path else sys.stdout
+  writer = ResultWriter(stream, output_order, reorder_buffer_size)
+  if timing_path is not None:
+    timing_stream = open(timing_path, "w", encoding="utf-8")
+  try:
+    if work_queue is not None:
+      queue_runner(sites, writer)
+    elif worker_count > 1:
+      sharded_runner(sites, writer)
+    elif pipeline_mode:
+      pipelined_runner(sites, writer)
+    else:
+      asyncio.run(async_runner(sites, writer))
+  finally:
+    writer.close()
+    if output_path:
+      stream.close()
+    if timing_stream is not None:
+      timing_stream.close()
+      timing_stream = None
+
+  if expiry_index is not None:
+    write_expiry_alerts()
+
+  if logger.isEnabledFor(logging.INFO):
+    log_run_summary()
+  
+  
+
+def build_arg_parser() -> argparse.ArgumentParser:
+  """Builds the command line argument parser"""
+  parser = argparse.ArgumentParser()
+  site_args = parser.add_mutually_exclusive_group()
+  site_args.add_argument("--sites", nargs="?", help="A comma seperated list of sites to query")
+  site_args.add_argument("--sites_file", "--sites-file", help="A file of sites to query, one per line or CSV, optionally gzipped. Use - for stdin.")
+  parser.add_argument("--force_test", action="store_true")
+  parser.add_argument("--use_cache", action="store_true")
+  parser.add_argument("-d", "--debug", action="store_true")
+  parser.add_argument("-v", "--verbose", action="store_true")
+  parser.add_argument("-q", "--quiet", action="store_true", help="Only output warnings and errors")
+  parser.add_argument("--concurrency", type=int, default=max_concurrency, help="The number of sites to assess at the same time")
+  parser.add_argument("--full_polls", action="store_true", help="Request the full results on every poll instead of only the status")
+  parser.add_argument("--endpoint_data", action="store_true", help="Fetch the full results per endpoint from /getEndpointData")
+  parser.add_argument("--cache_db", help="Path to a SQLite file used to cache parsed results locally between runs")
+  parser.add_argument("--cache_ttl", type=float, default=local_cache_ttl, help="How long in hours a locally cached result is used for")
+  parser.add_argument("--cache_raw", action="store_true", help="Also store the raw API response in the local cache")
+  parser.add_argument("--journal", help="Path to a file that records the progress of each site as the run goes")
+  parser.add_argument("--resume", action="store_true", help="Resume an interrupted run from the journal")
+  parser.add_argument("--output", help="Path to a file to write the results to instead of stdout")
+  parser.add_argument("--output_order", choices=["input", "completion"], default=output_order, help="The order results are written in")
+  parser.add_argument("--reorder_buffer", type=int, default=reorder_buffer_size, help="How many sites can finish ahead of the oldest unfinished one in input order")
+  parser.add_argument("--endpoint_fields", help="A comma seperated list of endpoint fields to output instead of the default report")
+  parser.add_argument("--backend", choices=["ssllabs", "tls"], default=scan_backend, help="Assess sites with SSL Labs or only pull their certificates with a direct TLS handshake")
+  parser.add_argument("--tls_port", type=int, default=tls_probe_port, help="The port to connect to with the tls backend")
+  parser.add_argument("--api_url", default=SSL_LABS_BASE_URL, help="Base URL of the SSL Labs API")
+  parser.add_argument("--rate_limit", type=float, help="The most API requests to send per second")
+  parser.add_argument("--rate_limit_burst", type=float, help="How many requests can be sent back to back before the rate limit applies")
+  parser.add_argument("--rate_limit_db", help="Path to a SQLite file holding the rate limit state, shared by every process that uses it")
+  parser.add_argument("--request_deadline", type=float, default=request_deadline, help="The longest time in seconds to keep retrying a single API request")
+  parser.add_argument("--pipeline", action="store_true", help="Start assessments for as many sites as the API allows, then check on all of them from a single loop")
+  parser.add_argument("--queue", help="A work queue shared with other runs to claim sites from, e.g. a SQLite file path")
+  parser.add_argument("--lease_time", type=float, default=lease_time, help="How long in seconds a claimed site is held before another run can take it over")
+  parser.add_argument("--json_decoder", choices=["msgspec", "orjson", "json"], default=json_decoder, help="The library used to decode API responses")
+  parser.add_argument("--expiry_alerts", help="Path to write alerts for certificates close to expiring to as JSON lines, or - for stdout")
+  parser.add_argument("--expiry_thresholds", default="30,14,7,1", help="Comma seperated days before expiry to alert at")
+  parser.add_argument("--incremental", action="store_true", help="Only reassess sites whose addresses or certificates changed since their cached result")
+  parser.add_argument("--max_age", type=float, default=incremental_max_age, help="With --incremental, how long in hours a cached result can be reused for")
+  parser.add_argument("--timing_file", help="Path to write how long each site spent in each phase to as JSON lines")
+  parser.add_argument("--workers", type=int, default=1, help="Split the sites across this many worker processes")
+  parser.add_argument("--min_poll_interval", type=float, default=min_poll_interval, help="The shortest time in seconds to wait between polls of a site")
+  parser.add_argument("--max_poll_interval", type=float, default=max_poll_interval, help="The longest time in seconds to wait between polls of a site")
+  return parser
+
+def configure(args: argparse.Namespace) -> None:
+  """Applies the command line arguments. Raises ValueError if they don't make sense together.
+
+  Worker processes call this with the parent's arguments to get the same settings.
+  """
+  if args.sites is None and args.sites_file is None and not args.queue:
+    raise ValueError("one of the arguments --sites --sites_file is required")
+
+  if args.resume and not args.journal:
+    raise ValueError("--resume requires --journal")
+
+  if args.debug:
+    setup_logging(logging.DEBUG)
+  elif args.quiet:
+    setup_logging(logging.WARNING)
+  else:
+    setup_logging(logging.INFO)
+
+  if args.force_test:
+    enable_force_test()
+  
+  if args.use_cache:
+    enable_cache_use()
+
+  set_concurrency(args.concurrency)
+
+  if args.endpoint_fields:
+    set_endpoint_fields(args.endpoint_fields.split(","))
+
+  if args.full_polls:
+    enable_full_polls()
+
+  if args.endpoint_data:
+    enable_endpoint_data()
+
+  set_poll_interval(args.min_poll_interval, args.max_poll_interval)
+
+  set_backend(args.backend, args.tls_port)
+
+  if args.pipeline:
+    if args.backend != "ssllabs":
+      raise ValueError("--pipeline only works with the ssllabs backend")
+    enable_pipeline()
+
+  set_api_url(args.api_url)
+
+  if args.rate_limit:
+    enable_rate_limit(args.rate_limit, args.rate_limit_burst, args.rate_limit_db)
+  elif args.rate_limit_db:
+    raise ValueError("--rate_limit_db requires --rate_limit")
+
+  set_request_deadline(args.request_deadline)
+
+  if args.cache_db:
+    enable_result_cache(args.cache_db, args.cache_ttl, args.cache_raw)
+
+  if args.journal:
+    enable_journal(args.journal, args.resume)
+
+  if args.incremental:
+    if args.backend != "ssllabs":
+      raise ValueError("--incremental only works with the ssllabs backend")
+    if args.pipeline:
+      raise ValueError("--incremental doesn't work with --pipeline, the handshakes need the asyncio engine")
+    enable_incremental(args.max_age)
+
+  set_output(args.output, args.output_order, args.reorder_buffer)
+
+  set_json_decoder(args.json_decoder)
+
+  if args.timing_file:
+    enable_timing_file(args.timing_file)
+
+  if args.expiry_alerts:
+    try:
+      thresholds = [int(t) for t in args.expiry_thresholds.split(",")]
+    except ValueError:
+      raise ValueError(f"Invalid expiry thresholds {args.expiry_thresholds}")
+    enable_expiry_alerts(args.expiry_alerts, thresholds)
+
+  if args.workers > 1:
+    if args.queue:
+      raise ValueError("--workers can't be combined with --queue, start more runs against the same queue instead")
+    enable_workers(args.workers, args)
+
+  if args.queue:
+    enable_work_queue(args.queue, args.lease_time)
+
+if __name__ == "__main__":
+
+  parser = build_arg_parser()
+  args = parser.parse_args()
+
+  try:
+    configure(args)
+  except ValueError as e:
+    parser.error(str(e))
+
+  if args.force_test:
+    logger.info("Enabling force test")
+
+  if args.sites_file:
+    sites = unique_sites(read_sites_file(args.sites_file))
+  elif args.sites:
+    sites = unique_sites(args.sites.split(","))
+  else:
+    sites = []
+
+  runner(sites)